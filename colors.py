@@ -1,7 +1,7 @@
 import os
+import re
 import math
 import json
-import pickle
 import numpy as np
 import pandas as pd
 from PIL import Image
@@ -9,6 +9,8 @@ from glob import glob
 from tqdm import tqdm
 from nltk import sent_tokenize, word_tokenize
 
+from data import color_features, vocab_key
+
 import torch
 import torch.utils.data as data
 from torchvision import transforms
@@ -46,6 +48,8 @@ class ColorsInContext(data.Dataset):
             min_token_occ = 2,
             max_sent_len = 16,
             random_seed = 42,
+            features = None,
+            fast_tokenizer = False,
             **kwargs
         ):
 
@@ -71,6 +75,8 @@ class ColorsInContext(data.Dataset):
         self.min_token_occ = min_token_occ
         self.max_sent_len = max_sent_len
         self.random_seed = random_seed
+        self.features = features
+        self.fast_tokenizer = fast_tokenizer
         self.subset_indices = None
 
         print('1')
@@ -86,60 +92,38 @@ class ColorsInContext(data.Dataset):
         if not os.path.isdir(self.cache_dir):
             os.makedirs(self.cache_dir)
 
-        cache_clean_data = os.path.join(
-            self.cache_dir,
-            f'clean_data_{self.context_condition}.pickle',
-        )
-        
-        if not os.path.isfile(cache_clean_data):
-            csv_path = os.path.join(self.data_dir, 'filteredCorpus.csv')
-            df = pd.read_csv(csv_path)
-            df = df[df['outcome'] == True]
-            df = df[df['role'] == 'speaker']
-            df = df.dropna()
+        # Columnar corpus: float32 HSL columns plus a utf-8 utterance buffer
+        hsl, text_buf, text_offsets = self._load_corpus()
+        self._text_buf, self._text_offsets = text_buf, text_offsets
 
-            if self.context_condition != 'all':
-                df = df[df['condition'] == self.context_condition]
-            
-            data = df[[
-                    'clickColH',
-                    'clickColS',
-                    'clickColL',
-                    'alt1ColH',
-                    'alt1ColS',
-                    'alt1ColL',
-                    'alt2ColH',
-                    'alt2ColS',
-                    'alt2ColL',
-                    'contents',
-            ]]
-            data = np.asarray(data)
-            
-            print('Saving cleaned data to pickle.')
-            with open(cache_clean_data, 'wb') as fp:
-                pickle.dump(data, fp)
-        else:
-            print('Loading cleaned data from pickle.')
-            with open(cache_clean_data, 'rb') as fp:
-                data = pickle.load(fp)
+        # Tokenized once per corpus and shared by all splits through the cache
+        corpus_tokens, corpus_offsets = self._corpus_tokens(
+            self._decode_text(range(len(hsl))))
 
-        data = self._process_splits(data)
+        # Rows of the cleaned corpus in this split
+        rows = self._split_rows(len(hsl))
 
         if data_size is not None:
             rs = np.random.RandomState(self.random_seed)
-            n_train_total = len(data)
+            n_train_total = len(rows)
             indices = np.arange(n_train_total)
             n_train_total = int(math.ceil(data_size * n_train_total))
             indices = rs.choice(indices, size=n_train_total)
-            data = data[indices]
+            rows = rows[indices]
 
             self.subset_indices = indices
 
-        text = [d[-1] for d in data]
+        self.rows = rows
+        data = np.asarray(hsl[rows])
+        text = list(self._decode_text(rows))
+        tokens = [
+            list(corpus_tokens[corpus_offsets[r]:corpus_offsets[r + 1]])
+            for r in rows
+        ]
 
         if vocab is None:
             print('Building vocabulary')
-            self.vocab = self.build_vocab(text)
+            self.vocab = self.build_vocab(text, tokens=tokens)
         else:
             self.vocab = vocab
 
@@ -156,9 +140,22 @@ class ColorsInContext(data.Dataset):
         self.pad_index = self.w2i[self.pad_token]
         self.unk_index = self.w2i[self.unk_token]
 
-        text_seq, text_len, text_raw = self._process_text(text)
+        corpus_seq, corpus_len = self._corpus_ids(corpus_tokens, corpus_offsets)
+        text_seq = np.asarray(corpus_seq[rows])
+        text_len = np.asarray(corpus_len[rows])
+        text_raw = tokens
 
         self.data = data
+        # Every stimulus is a solid color patch, so with the default transform
+        # an item is just its 3 RGB triples broadcast over the image
+        hsl = data.astype(np.float64).reshape(-1, 3, 3)
+        rgb = hsl2rgb_array(hsl[..., 0], hsl[..., 1] / 100., hsl[..., 2] / 100.)
+        rgb = torch.from_numpy(rgb).float().div(255)
+        self.rgb = rgb if image_transform is None else None
+        # (n, 3, D) color vectors for a models.FeatureMLP feat_model
+        self.feats = None
+        if features is not None:
+            self.feats = torch.from_numpy(color_features(rgb.numpy(), features))
         self.text_seq = text_seq
         self.text_len = text_len
         self.text_raw = text_raw
@@ -178,24 +175,170 @@ class ColorsInContext(data.Dataset):
         accuracy = np.asarray(df['outcome']).astype(np.float).mean()
         return accuracy
 
-    def _process_splits(self, data):
+    def _process_splits(self, data, split=None):
+        # data may also be row indices; the shuffle is the same either way
+        split = self.split if split is None else split
         rs = np.random.RandomState(self.random_seed)
         rs.shuffle(data)
 
         n_train = int(self.train_frac * len(data))
         n_val = int((self.train_frac + self.val_frac) * len(data))
         
-        if self.split == 'train':
+        if split == 'train':
             data = data[:n_train]
-        elif self.split == 'val':
+        elif split == 'val':
             data = data[n_train:n_val]
-        elif self.split == 'test':
+        elif split == 'test':
             data = data[n_val:]
         else:
-            raise Exception(f'split {self.split} not supported.')
+            raise Exception(f'split {split} not supported.')
         return data
     
-    def build_vocab(self, texts):
+    def _load_corpus(self):
+        """
+        Cleaned corpus for ``context_condition`` as (n, 9) float32 target,
+        alt1 and alt2 HSL columns, a utf-8 buffer of all utterances and their
+        byte offsets. Built from ``filteredCorpus.csv`` once, then
+        memory-mapped.
+        """
+        cache = os.path.join(self.cache_dir, f'corpus_{self.context_condition}')
+        if not os.path.isfile(os.path.join(cache, 'meta.json')):
+            print('Building columnar corpus cache.')
+            csv_path = os.path.join(self.data_dir, 'filteredCorpus.csv')
+            df = pd.read_csv(csv_path)
+            df = df[df['outcome'] == True]
+            df = df[df['role'] == 'speaker']
+            df = df.dropna()
+
+            if self.context_condition != 'all':
+                df = df[df['condition'] == self.context_condition]
+
+            hsl = np.asarray(df[[
+                    'clickColH',
+                    'clickColS',
+                    'clickColL',
+                    'alt1ColH',
+                    'alt1ColS',
+                    'alt1ColL',
+                    'alt2ColH',
+                    'alt2ColS',
+                    'alt2ColL',
+            ]], dtype=np.float32)
+            encoded = [str(t).encode('utf-8') for t in df['contents']]
+            text_buf = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            text_offsets = np.cumsum([0] + [len(t) for t in encoded])
+
+            os.makedirs(cache, exist_ok=True)
+            np.save(os.path.join(cache, 'hsl.npy'), hsl)
+            np.save(os.path.join(cache, 'text_buf.npy'), text_buf)
+            np.save(os.path.join(cache, 'text_offsets.npy'), text_offsets)
+            # Written last, so its presence marks a complete cache
+            with open(os.path.join(cache, 'meta.json'), 'w') as f:
+                json.dump({'n': len(hsl)}, f)
+        return tuple(
+            np.load(os.path.join(cache, name + '.npy'), mmap_mode='r')
+            for name in ('hsl', 'text_buf', 'text_offsets')
+        )
+
+    def _decode_text(self, rows):
+        """Utterances of corpus ``rows``, decoded from the text buffer."""
+        buf, offsets = self._text_buf, self._text_offsets
+        for r in rows:
+            yield buf[offsets[r]:offsets[r + 1]].tobytes().decode('utf-8')
+
+    def _split_rows(self, n):
+        """
+        Corpus rows of ``split``: a seeded shuffle of all rows cut by
+        ``train_frac``/``val_frac``, computed once and cached on disk.
+        """
+        path = os.path.join(
+            self.cache_dir,
+            f'splits_{self.context_condition}_{self.random_seed}_{self.train_frac}_{self.val_frac}.npz',
+        )
+        if not os.path.isfile(path):
+            splits = {
+                split: self._process_splits(np.arange(n), split)
+                for split in ('train', 'val', 'test')
+            }
+            np.savez(path, **splits)
+        splits = np.load(path)
+        if self.split not in splits:
+            raise Exception(f'split {self.split} not supported.')
+        return splits[self.split]
+
+    @property
+    def tokenizer_mode(self):
+        return 'fast' if self.fast_tokenizer else 'nltk'
+
+    def _corpus_tokens(self, texts):
+        """
+        Cleaned tokens of every utterance in the corpus, as a flat string
+        array plus offsets (utterance i is ``tokens[offsets[i]:offsets[i + 1]]``),
+        cached on disk per ``context_condition`` and tokenizer and memory-mapped.
+        A fast cache is only built if a random sample of TOKENIZER_CHECK_SIZE
+        utterances tokenizes exactly as with NLTK; the rest are not checked.
+        """
+        cache = os.path.join(self.cache_dir, f'tokens_{self.context_condition}_{self.tokenizer_mode}')
+        if not os.path.isfile(os.path.join(cache, 'meta.json')):
+            print('Tokenizing corpus.')
+            texts = list(texts)
+            if self.fast_tokenizer:
+                # Spot-check the regex path against NLTK before caching it
+                rs = np.random.RandomState(self.random_seed)
+                sample = rs.choice(len(texts), size=min(len(texts), TOKENIZER_CHECK_SIZE), replace=False)
+                mismatched = check_tokenizer([texts[i] for i in sample])
+                if mismatched:
+                    raise Exception(
+                        f'fast tokenizer differs from NLTK on {mismatched[:5]}; '
+                        'use fast_tokenizer=False')
+            utterances = [tokenize(t, self.fast_tokenizer) for t in tqdm(texts)]
+            n = len(utterances)
+            tokens = np.array([t for u in utterances for t in u], dtype=np.str_)
+            offsets = np.cumsum([0] + [len(u) for u in utterances])
+            os.makedirs(cache, exist_ok=True)
+            np.save(os.path.join(cache, 'tokens.npy'), tokens)
+            np.save(os.path.join(cache, 'offsets.npy'), offsets)
+            # Written last, so its presence marks a complete cache
+            with open(os.path.join(cache, 'meta.json'), 'w') as f:
+                json.dump({'n': n}, f)
+        return (np.load(os.path.join(cache, 'tokens.npy'), mmap_mode='r'),
+                np.load(os.path.join(cache, 'offsets.npy'), mmap_mode='r'))
+
+    def _corpus_ids(self, tokens, offsets):
+        """
+        Padded token ids and lengths of every utterance in the corpus (see
+        ``_process_text``), cached on disk per vocab, ``max_sent_len``,
+        ``context_condition`` and tokenizer and memory-mapped.
+        """
+        key = vocab_key(self.vocab)
+        cache = os.path.join(
+            self.cache_dir,
+            f'text_{self.context_condition}_{self.tokenizer_mode}_{self.max_sent_len}_{key}',
+        )
+        if not os.path.isfile(os.path.join(cache, 'meta.json')):
+            n = len(offsets) - 1
+            L = self.max_sent_len
+            ids = np.array([self.w2i.get(t, self.unk_index) for t in tokens], dtype=np.int64)
+            lens = np.minimum(np.diff(offsets), L)
+            text_seq = np.full((n, L + 2), self.pad_index, dtype=np.int64)
+            text_seq[:, 0] = self.sos_index
+            # Scatter the first max_sent_len tokens of each utterance
+            pos = np.arange(L)
+            keep = pos[None, :] < lens[:, None]
+            src = (offsets[:-1, None] + pos[None, :])[keep]
+            text_seq[:, 1:L + 1][keep] = ids[src]
+            text_seq[np.arange(n), lens + 1] = self.eos_index
+            text_len = lens + 2
+
+            os.makedirs(cache, exist_ok=True)
+            np.save(os.path.join(cache, 'text_seq.npy'), text_seq)
+            np.save(os.path.join(cache, 'text_len.npy'), text_len)
+            with open(os.path.join(cache, 'meta.json'), 'w') as f:
+                json.dump({'n': n, 'vocab_key': key}, f)
+        return (np.load(os.path.join(cache, 'text_seq.npy'), mmap_mode='r'),
+                np.load(os.path.join(cache, 'text_len.npy'), mmap_mode='r'))
+
+    def build_vocab(self, texts, tokens=None):
         w2i = dict()
         i2w = dict()
         w2c = OrderedCounter()
@@ -205,11 +348,11 @@ class ColorsInContext(data.Dataset):
             i2w[len(w2i)] = st
             w2i[st] = len(w2i)
 
+        if tokens is None:
+            tokens = (tokenize(text, self.fast_tokenizer) for text in texts)
         pbar = tqdm(total=len(texts))
-        for text in texts:
-            tokens = word_tokenize(text.lower())
-            tokens = clean_tokens(tokens)
-            w2c.update(tokens)
+        for _tokens in tokens:
+            w2c.update(_tokens)
             pbar.update()
         pbar.close()
 
@@ -227,8 +370,7 @@ class ColorsInContext(data.Dataset):
         text_seq, text_len, raw_tokens = [], [], []
 
         for i in range(len(text)):
-            _tokens = word_tokenize(text[i].lower())
-            _tokens = clean_tokens(_tokens)
+            _tokens = tokenize(text[i], self.fast_tokenizer)
             
             tokens = [SOS_TOKEN] + _tokens[:self.max_sent_len] + [EOS_TOKEN]
             length = len(tokens)
@@ -251,7 +393,17 @@ class ColorsInContext(data.Dataset):
         return self.text_raw[index]
     
     def __getitem__(self, index):
-        h_tgt, s_tgt, l_tgt, h_alt1, s_alt1, l_alt1, h_alt2, s_alt2, l_alt2, _ = self.data[index]
+        if self.feats is not None:
+            text_seq = torch.from_numpy(self.text_seq[index]).long()
+            return self.feats[index], 0, text_seq
+
+        if self.rgb is not None:
+            imgs = self.rgb[index][:, :, None, None]\
+                .expand(3, 3, self.image_size, self.image_size)
+            text_seq = torch.from_numpy(self.text_seq[index]).long()
+            return imgs, 0, text_seq
+
+        h_tgt, s_tgt, l_tgt, h_alt1, s_alt1, l_alt1, h_alt2, s_alt2, l_alt2 = self.data[index]
        
         r_tgt, g_tgt, b_tgt = hsl2rgb(h_tgt, s_tgt / 100., l_tgt / 100.)
         r_alt1, g_alt1, b_alt1 = hsl2rgb(h_alt1, s_alt1 / 100., l_alt1 / 100.)
@@ -311,6 +463,65 @@ def hsl2rgb(H, S, L):
     return (R, G, B)
 
 
+def hsl2rgb_array(H, S, L):
+    """
+    Vectorized ``hsl2rgb``: converts arrays of hue (degrees), saturation and
+    lightness (both in [0, 1]) to a uint8 array of shape H.shape + (3, ).
+    """
+    H = np.asarray(H, dtype=np.float64)
+    S = np.asarray(S, dtype=np.float64)
+    L = np.asarray(L, dtype=np.float64)
+    assert ((0 <= H) & (H <= 360)).all() and ((0 <= S) & (S <= 1)).all() \
+        and ((0 <= L) & (L <= 1)).all()
+
+    C = (1 - np.abs(2 * L - 1)) * S
+    X = C * (1 - np.abs((H / 60.) % 2 - 1))
+    m = L - C / 2.
+    Z = np.zeros_like(C)
+
+    # Row k holds (R', G', B') for hues in [60k, 60(k+1))
+    sector = np.minimum((H // 60).astype(np.int64), 5)
+    table = np.stack([
+        np.stack([C, X, Z], -1),
+        np.stack([X, C, Z], -1),
+        np.stack([Z, C, X], -1),
+        np.stack([Z, X, C], -1),
+        np.stack([X, Z, C], -1),
+        np.stack([C, Z, X], -1),
+    ], 0)
+    rgb_p = np.take_along_axis(table, sector[None, ..., None], 0)[0]
+    return ((rgb_p + m[..., None]) * 255.).astype(np.uint8)
+
+
+# Plain words (no double hyphens), commas and one final . ! or ?: NLTK's
+# word_tokenize just splits these off, see check_tokenizer. Words NLTK splits
+# in two (its CONTRACTIONS2, e.g. "cannot" -> "can not") go through NLTK.
+SIMPLE_TEXT = re.compile(r"^(?!.*--)(?!.*\b(?:cannot|gimme|gonna|gotta|lemme|wanna)\b)\s*(?:[a-z0-9][a-z0-9/-]*,?\s+)*[a-z0-9][a-z0-9/-]*[.!?]?\s*$")
+PUNCT = re.compile(r"([,.!?])")
+# Utterances check_tokenizer compares when a fast token cache is first built
+TOKENIZER_CHECK_SIZE = 2000
+
+
+def tokenize(text, fast=False):
+    """
+    Lowercase, tokenize and clean an utterance. With ``fast``, utterances
+    matching ``SIMPLE_TEXT`` are split with a regex instead of NLTK. The two
+    agree on every case we know of, but corpora are only spot-checked (see
+    ``ColorsInContext._corpus_tokens``).
+    """
+    text = text.lower()
+    if fast and SIMPLE_TEXT.match(text):
+        tokens = PUNCT.sub(r' \1', text).split()
+    else:
+        tokens = word_tokenize(text)
+    return clean_tokens(tokens)
+
+
+def check_tokenizer(texts):
+    """Utterances whose fast tokenization differs from NLTK's (should be empty)."""
+    return [t for t in texts if tokenize(t, fast=True) != tokenize(t)]
+
+
 def clean_tokens(tokens):
     i = 0
     while i < len(tokens):
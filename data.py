@@ -1,11 +1,20 @@
 """
 """
 
+import copy
+import hashlib
+import json
+import os
+import queue
+import threading
+
 import numpy as np
 from sklearn.model_selection import train_test_split
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 import random
 import string
 import shapeworld
+import views
 
 
 PAD_TOKEN = '<PAD>'
@@ -34,6 +43,9 @@ def init_vocab(langs):
     }
 
     for lang in langs:
+        if isinstance(lang, str):
+            # mmap shards store langs as raw strings
+            lang = lang.split()
         for tok in lang:
             if tok not in w2i:
                 i = len(w2i)
@@ -78,30 +90,481 @@ def train_val_test_split(data,
         })
     return splits
 
+class PaletteImages:
+    """
+    Array-like view of palette-indexed images (see ``shapeworld.palettize``).
+    Indexing gathers RGB values from the palette for just the selected games,
+    returning (..., 3, 64, 64) uint8 arrays like a regular transposed shard.
+    ``palette`` is either (n, P, 3), one per game, or a shared (P, 3) one.
+    """
+
+    def __init__(self, img_idx, palette):
+        self.img_idx = img_idx
+        self.palette = np.asarray(palette)
+        # (3, n * P), so a gather lands channels first
+        self._palette_t = np.ascontiguousarray(self.palette.reshape(-1, 3).T)
+        self.shape = img_idx.shape[:2] + (3, ) + img_idx.shape[2:]
+        self.dtype = self.palette.dtype
+
+    def __len__(self):
+        return len(self.img_idx)
+
+    def __getitem__(self, i):
+        idx = self.img_idx[i]
+        if self.palette.ndim == 3:
+            # Offset each game's indices into its own palette
+            game = np.arange(len(self))[i]
+            game = game.reshape(np.shape(game) + (1, ) * (idx.ndim - np.ndim(game)))
+            idx = game * self.palette.shape[1] + idx
+        rgb = np.take(self._palette_t, idx, axis=1)
+        return np.moveaxis(rgb, 0, -3)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+class SceneImages:
+    """
+    Array-like view of parametric scenes (see ``shapeworld.render_scenes``).
+    Indexing rasterizes just the selected games, returning (..., 3, 64, 64)
+    uint8 arrays like a regular transposed shard. The rasterizer only
+    approximates aggdraw (see ``shapeworld.compare_backends``).
+    """
+
+    def __init__(self, scenes, antialias=2):
+        self.scenes = scenes
+        self.antialias = antialias
+        self.shape = scenes.shape[:2] + (3, shapeworld.DIM, shapeworld.DIM)
+        self.dtype = np.dtype(np.uint8)
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def __getitem__(self, i):
+        rgb = shapeworld.render_scenes(self.scenes[i], antialias=self.antialias)
+        return np.moveaxis(rgb, -1, -3)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+FOURIER_FREQS = 3
+
+
+def color_features(rgb, kind='rgb'):
+    """
+    Featurize colors given as (..., 3) RGB values in [0, 1]: the RGB values
+    themselves (``'rgb'``) or those followed by sin/cos of ``FOURIER_FREQS``
+    frequencies per channel (``'fourier'``).
+    """
+    rgb = np.asarray(rgb, dtype=np.float32)
+    if kind == 'rgb':
+        return rgb
+    if kind == 'fourier':
+        angles = 2 * np.pi * rgb[..., None] * np.arange(1, FOURIER_FREQS + 1, dtype=np.float32)
+        angles = angles.reshape(rgb.shape[:-1] + (-1, ))
+        return np.concatenate((rgb, np.sin(angles), np.cos(angles)), -1)
+    raise ValueError(f'Unknown color features {kind}')
+
+
+def color_feature_dim(kind):
+    """Size of ``color_features(rgb, kind)`` per color."""
+    return 3 if kind == 'rgb' else 3 * (1 + 2 * FOURIER_FREQS)
+
+
+class ColorFeatures:
+    """
+    Array-like view of solid-color images (e.g. the Colors dataset) as one
+    ``color_features`` vector per object. Indexing reads a single pixel per
+    object and returns (..., n_obj, D) float32 arrays, so models can use a
+    ``models.FeatureMLP`` instead of a conv net.
+    """
+
+    def __init__(self, imgs, kind='rgb'):
+        self.imgs = imgs
+        self.kind = kind
+        self.shape = imgs.shape[:2] + (color_feature_dim(kind), )
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, i):
+        rgb = np.asarray(self.imgs[i])[..., 0, 0]
+        if np.issubdtype(rgb.dtype, np.integer):
+            rgb = rgb / 255.
+        return color_features(rgb, self.kind)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+def vocab_key(vocab):
+    """Fingerprint of a vocab, used to tie pre-tokenized shards to it."""
+    items = sorted(vocab['w2i'].items())
+    return hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()
+
+
+def mmap_dir(data_file):
+    """Directory holding the uncompressed version of an npz shard."""
+    return os.path.splitext(data_file)[0]
+
+
+def convert_to_mmap(data_file, vocab, out_dir=None, palette=False):
+    """
+    Convert a compressed npz shard into raw ``.npy`` arrays that can be opened
+    with ``mmap_mode='r'``. Images are stored already transposed to
+    (n, n_images, 3, 64, 64) and language is stored pre-tokenized against
+    ``vocab``.
+    Parameters
+    ----------
+    data_file : ``str``
+        Path to a shard written by ``shapeworld.py``
+    vocab : ``dict``
+        Vocab with ``w2i`` and ``i2w``, used to compute ``lang_idx``
+    out_dir : ``str``, optional (default: None)
+        Output directory, defaults to ``data_file`` without its extension
+    palette : ``bool``, optional (default: False)
+        Store images as a palette index image (see ``shapeworld.palettize``).
+        Parametric shards keep their scenes either way.
+    """
+    if out_dir is None:
+        out_dir = mmap_dir(data_file)
+    os.makedirs(out_dir, exist_ok=True)
+    d = load_raw_data(data_file)
+    dataset = ShapeWorld(d, vocab)
+    n = len(d['labels'])
+    arrays = {
+        'labels': d['labels'],
+        'langs': np.array([' '.join(t) for t in d['langs']], dtype=np.str_),
+        'lang_idx': dataset.lang_idx,
+        'lang_len': dataset.lang_len,
+    }
+    if isinstance(d['imgs'], SceneImages):
+        arrays['scenes'] = d['imgs'].scenes
+    elif isinstance(d['imgs'], PaletteImages):
+        arrays['img_idx'] = d['imgs'].img_idx
+        arrays['palette'] = d['imgs'].palette
+    elif palette:
+        imgs = np.asarray(d['imgs']).transpose(0, 1, 3, 4, 2)
+        arrays['img_idx'], arrays['palette'] = shapeworld.palettize(imgs)
+    else:
+        arrays['imgs'] = np.ascontiguousarray(d['imgs'])
+        assert arrays['imgs'].shape[0] == n and arrays['imgs'].shape[2:] == (3, shapeworld.DIM, shapeworld.DIM), \
+            arrays['imgs'].shape
+    # Never mark a malformed shard complete
+    assert len(arrays['langs']) == n and arrays['lang_idx'].shape[0] == n, (len(arrays['langs']), n)
+    assert np.issubdtype(arrays['lang_idx'].dtype, np.integer) and arrays['lang_idx'].ndim == 2, \
+        arrays['lang_idx'].dtype
+    for name, arr in arrays.items():
+        np.save(os.path.join(out_dir, name + '.npy'), arr)
+    # Written last, so its presence marks a complete shard
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'n': len(dataset), 'vocab_key': vocab_key(vocab)}, f)
+    return out_dir
+
+
+def load_mmap_data(shard_dir):
+    """Open a shard written by ``convert_to_mmap`` without reading it into memory."""
+    with open(os.path.join(shard_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    d = {
+        name: np.load(os.path.join(shard_dir, name + '.npy'), mmap_mode='r')
+        for name in ('imgs', 'img_idx', 'palette', 'scenes', 'labels', 'langs', 'lang_idx', 'lang_len')
+        if os.path.exists(os.path.join(shard_dir, name + '.npy'))
+    }
+    if 'img_idx' in d:
+        d['imgs'] = PaletteImages(d.pop('img_idx'), d.pop('palette'))
+    elif 'scenes' in d:
+        d['imgs'] = SceneImages(d.pop('scenes'))
+    d['vocab_key'] = meta['vocab_key']
+    return d
+
+
 def load_raw_data(data_file):
+    if os.path.isdir(data_file):
+        return load_mmap_data(data_file)
     data = np.load(data_file)
-    # Preprocessing/tokenization
-    try:
+    if 'game' in data:
+        # View over pool shards (see views.py): gather scenes, render lazily
+        return {
+            'imgs': SceneImages(views.view_scenes(data_file, data)),
+            'labels': data['labels'],
+            'langs': [t.lower().split() for t in data['langs']]
+        }
+    if 'scenes' in data and 'imgs' not in data:
+        # Parametric shard: render lazily, per batch
         return {
-            'imgs': data['imgs'].transpose(0, 1, 4, 2, 3),
+            'imgs': SceneImages(data['scenes']),
             'labels': data['labels'],
-            'langs': np.array([t.lower().split() for t in data['langs']])
+            'langs': [t.lower().split() for t in data['langs']]
         }
-    except:
+    if 'img_idx' in data:
+        # Palette shard: expand to RGB lazily, per batch
         return {
-            'imgs': data['imgs'],
+            'imgs': PaletteImages(data['img_idx'], data['palette']),
             'labels': data['labels'],
-            'langs': data['langs']
+            'langs': [t.lower().split() for t in data['langs']]
         }
+    # Preprocessing/tokenization
+    langs = [t.lower().split() for t in data['langs']]
+    try:
+        imgs = data['imgs'].transpose(0, 1, 4, 2, 3)
+    except ValueError:
+        # Not (n, n_images, 64, 64, 3): pass the images through as stored
+        imgs = data['imgs']
+    return {
+        'imgs': imgs,
+        'labels': data['labels'],
+        'langs': langs
+    }
+
+def prefetch_shards(data_files, vocab, depth=2, features=None):
+    """
+    Iterate over ``ShapeWorld`` datasets for ``data_files``, loading and
+    tokenizing upcoming shards on a background thread so that I/O and
+    decompression overlap with compute on the current shard.
+    Parameters
+    ----------
+    data_files : ``list``
+        Shard paths, as accepted by ``load_raw_data``
+    vocab : ``dict``
+        Vocab with ``w2i`` and ``i2w``
+    depth : ``int``, optional (default: 2)
+        Maximum number of loaded shards waiting to be consumed. 0 loads
+        shards serially on the calling thread.
+    features : ``str``, optional (default: None)
+        Serve ``ColorFeatures`` of this kind instead of images
+    """
+    if depth <= 0:
+        for file in data_files:
+            yield ShapeWorld(load_raw_data(file), vocab, features=features)
+        return
+
+    done = object()
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for file in data_files:
+                if not put(ShapeWorld(load_raw_data(file), vocab, features=features)):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(done)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def pad_lang(lang_idx, max_len):
+    """Right-pad (or trim) a (n, L) array of token ids to (n, max_len)."""
+    padded = np.full((lang_idx.shape[0], max_len), PAD_IDX, dtype=lang_idx.dtype)
+    width = min(max_len, lang_idx.shape[1])
+    padded[:, :width] = lang_idx[:, :width]
+    return padded
+
+
+def shuffled_batches(data_files,
+                     vocab,
+                     batch_size,
+                     buffer_size=5000,
+                     seed=None,
+                     max_len=40,
+                     prefetch=2,
+                     features=None):
+    """
+    Stream (imgs, labels, lang_idx) batches across shards in shuffled order.
+    Shards are visited in a seeded random order and their games are mixed in
+    a bounded shuffle buffer, so batches span shard boundaries while at most
+    ``buffer_size`` games plus one shard are held in memory.
+    Parameters
+    ----------
+    data_files : ``list``
+        Shard paths, as accepted by ``load_raw_data``
+    vocab : ``dict``
+        Vocab with ``w2i`` and ``i2w``
+    batch_size : ``int``
+        Games per batch; only the final batch may be smaller
+    buffer_size : ``int``, optional (default: 5000)
+        Games kept back in the shuffle buffer between shards
+    seed : ``int``, optional (default: None)
+        Seed for the shard order and the shuffle buffer
+    max_len : ``int``, optional (default: 40)
+        Width that ``lang_idx`` is padded to, so shards can be mixed
+    prefetch : ``int``, optional (default: 2)
+        Shards loaded ahead in the background, see ``prefetch_shards``
+    features : ``str``, optional (default: None)
+        Serve ``ColorFeatures`` of this kind instead of images
+    """
+    rs = np.random.RandomState(seed)
+    files = [data_files[i] for i in rs.permutation(len(data_files))]
+    buf = None
+    for shard in prefetch_shards(files, vocab, depth=prefetch, features=features):
+        new = (shard.imgs, shard.labels, pad_lang(shard.lang_idx, max_len))
+        if buf is None:
+            buf = new
+        else:
+            buf = tuple(np.concatenate((b, n)) for b, n in zip(buf, new))
+        perm = rs.permutation(len(buf[0]))
+        buf = tuple(b[perm] for b in buf)
+        # Emit whole batches, keeping buffer_size games back to mix with
+        # the next shard
+        n_out = max(len(buf[0]) - buffer_size, 0) // batch_size * batch_size
+        for start in range(0, n_out, batch_size):
+            yield tuple(b[start:start + batch_size] for b in buf)
+        buf = tuple(b[n_out:] for b in buf)
+
+    if buf is not None:
+        for start in range(0, len(buf[0]), batch_size):
+            yield tuple(b[start:start + batch_size] for b in buf)
+
+
+class ProceduralShapeWorld(IterableDataset):
+    """
+    ShapeWorld reference games generated on the fly instead of read from
+    shards. Yields (imgs, labels, lang_idx) batches like ``shuffled_batches``.
+    With ``num_workers`` > 0, batches are generated in DataLoader worker
+    processes and handed over in shared memory.
+
+    Batch b of epoch e is generated from seed (seed, e, b) (see
+    ``shapeworld.game_seed``), so an epoch is reproducible whatever the number
+    of workers, up to the order batches arrive in.
+    Parameters
+    ----------
+    vocab : ``dict``
+        Vocab with ``w2i`` and ``i2w``
+    n_batches : ``int``
+        Batches per epoch; None generates forever
+    batch_size : ``int``, optional (default: 32)
+        Games per batch
+    img_type : ``str``, optional (default: 'single')
+        Key of ``shapeworld.IMG_FUNCS``
+    n_images : ``int``, optional (default: 3)
+        Images per game
+    backend : ``str``, optional (default: 'aggdraw')
+        Image backend, see ``shapeworld.generate``. 'numpy' is faster but its
+        images differ slightly from aggdraw's, so listeners trained on aggdraw
+        shards should be retrained before judging speakers trained on it
+    seed : ``int``, optional (default: 0)
+        Base seed
+    max_len : ``int``, optional (default: 40)
+        Width that ``lang_idx`` is padded to
+    num_workers : ``int``, optional (default: 0)
+        DataLoader workers used by ``loader``
+    """
+
+    def __init__(self, vocab, n_batches, batch_size=32, img_type='single',
+                 n_images=3, backend='aggdraw', seed=0, max_len=40, num_workers=0):
+        self.vocab = vocab
+        self.n_batches = n_batches
+        self.batch_size = batch_size
+        self.img_type = img_type
+        self.n_images = n_images
+        self.backend = backend
+        self.seed = seed
+        self.max_len = max_len
+        self.num_workers = num_workers
+        self.epoch = 0
+
+    def __len__(self):
+        return self.n_batches
+
+    def batch(self, b):
+        """Generate batch ``b`` of the current epoch."""
+        d = shapeworld.generate(
+            self.batch_size, self.n_images, 0.5, data_type='reference',
+            img_func=shapeworld.IMG_FUNCS[self.img_type], do_mp=False,
+            backend=self.backend, seed=(self.seed, self.epoch, b))
+        langs = [t.lower().split() for t in d['langs']]
+        games = ShapeWorld({'imgs': d['imgs'], 'labels': d['labels'], 'langs': langs}, self.vocab)
+        return (d['imgs'].transpose(0, 1, 4, 2, 3), d['labels'],
+                pad_lang(games.lang_idx, self.max_len))
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, n_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        b = worker
+        while self.n_batches is None or b < self.n_batches:
+            yield self.batch(b)
+            b += n_workers
+
+    def loader(self, batch_size=None, epoch=None, pin_memory=False):
+        """
+        DataLoader over a copy of this dataset with ``batch_size`` and
+        ``epoch`` (if given), generating batches in ``num_workers`` processes.
+        """
+        dataset = copy.copy(self)
+        if batch_size is not None:
+            dataset.batch_size = batch_size
+        if epoch is not None:
+            dataset.epoch = epoch
+        return DataLoader(dataset, batch_size=None, num_workers=self.num_workers,
+                          pin_memory=pin_memory)
+
+
+class BatchSlices:
+    """
+    Sampler yielding one contiguous ``slice`` per batch. Used with
+    ``DataLoader(dataset, batch_size=None, sampler=BatchSlices(...))`` so that
+    ``ShapeWorld.__getitem__`` is called once per batch and returns array
+    slices, instead of once per game followed by a collate that re-stacks them.
+    """
+
+    def __init__(self, n, batch_size):
+        self.n = n
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for start in range(0, self.n, self.batch_size):
+            yield slice(start, min(start + self.batch_size, self.n))
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
 
 class ShapeWorld:
-    def __init__(self, data, vocab):
+    def __init__(self, data, vocab, features=None):
         self.imgs = data['imgs']
+        if features is not None:
+            self.imgs = ColorFeatures(self.imgs, features)
         self.labels = data['labels']
         # Get vocab
         self.w2i = vocab['w2i']
         self.i2w = vocab['i2w']
-        if len(vocab['w2i']) > 100:
+        if 'lang_idx' in data:
+            # Pre-tokenized (mmap) shard: index it as-is
+            if data['vocab_key'] != vocab_key(vocab):
+                raise ValueError('Shard was tokenized with a different vocab')
+            self.lang_raw = data['langs']
+            self.lang_idx = data['lang_idx']
+            self.lang_len = data['lang_len']
+        elif len(vocab['w2i']) > 100:
             self.lang_raw = data['langs']
             self.lang_idx = data['langs']
         else:
@@ -112,31 +575,76 @@ class ShapeWorld:
         return len(self.lang_raw)
 
     def __getitem__(self, i):
-        # Reference game format.
+        # Reference game format. i may also be a slice (see BatchSlices),
+        # which returns views of the whole batch.
         img = self.imgs[i]
         label = self.labels[i]
         lang = self.lang_idx[i]
         return (img, label, lang)
 
+    def vocab_arrays(self):
+        """
+        NumPy lookup tables for the vocab: tokens sorted for ``searchsorted``
+        with their ids (token -> id), and an id -> token array.
+        """
+        if not hasattr(self, '_vocab_arrays'):
+            toks = np.array(list(self.w2i.keys()), dtype=np.str_)
+            ids = np.array(list(self.w2i.values()), dtype=np.int64)
+            order = np.argsort(toks)
+            itos = np.array([self.i2w.get(i, UNK_TOKEN) for i in range(ids.max() + 1)],
+                            dtype=np.str_)
+            self._vocab_arrays = (toks[order], ids[order], itos)
+        return self._vocab_arrays
+
     def to_text(self, idxs):
-        texts = []
-        for lang in idxs:
-            toks = []
-            for i in lang:
-                i = i.item()
-                if i == self.w2i[PAD_TOKEN]:
-                    break
-                toks.append(self.i2w.get(i, UNK_TOKEN))
-            texts.append(' '.join(toks))
-        return texts
+        _, _, itos = self.vocab_arrays()
+        if hasattr(idxs, 'cpu'):
+            idxs = idxs.cpu()
+        idxs = np.asarray(idxs)
+        # Keep everything before the first PAD
+        keep = np.cumprod(idxs != self.w2i[PAD_TOKEN], axis=1).astype(bool)
+        known = (idxs >= 0) & (idxs < len(itos))
+        toks = np.where(known, itos[np.where(known, idxs, 0)], UNK_TOKEN)
+        return [' '.join(row[k]) for row, k in zip(toks, keep)]
 
     def to_idx(self, langs):
+        sorted_toks, sorted_ids, _ = self.vocab_arrays()
+        n_toks = np.array([len(t) for t in langs], dtype=np.int64)
+        flat = np.array([tok for toks in langs for tok in toks], dtype=np.str_)
+
+        # token -> id, falling back to UNK
+        pos = np.searchsorted(sorted_toks, flat)
+        pos = np.minimum(pos, len(sorted_toks) - 1)
+        found = sorted_toks[pos] == flat
+        flat_idx = np.where(found, sorted_ids[pos], self.w2i[UNK_TOKEN])
+
         # Add SOS, EOS
-        lang_len = np.array([len(t) for t in langs], dtype=np.int) + 2
-        lang_idx = np.full((len(self), max(lang_len)), self.w2i[PAD_TOKEN], dtype=np.int)
-        for i, toks in enumerate(langs):
-            lang_idx[i, 0] = self.w2i[SOS_TOKEN]
-            for j, tok in enumerate(toks, start=1):
-                lang_idx[i, j] = self.w2i.get(tok, self.w2i[UNK_TOKEN])
-            lang_idx[i, j + 1] = self.w2i[EOS_TOKEN]
-        return lang_idx, lang_len
\ No newline at end of file
+        lang_len = n_toks + 2
+        lang_idx = np.full((len(self), max(lang_len)), self.w2i[PAD_TOKEN], dtype=np.int64)
+        lang_idx[:, 0] = self.w2i[SOS_TOKEN]
+        rows = np.repeat(np.arange(len(langs)), n_toks)
+        starts = np.cumsum(n_toks) - n_toks
+        cols = np.arange(len(flat)) - np.repeat(starts, n_toks) + 1
+        lang_idx[rows, cols] = flat_idx
+        lang_idx[np.arange(len(langs)), n_toks + 1] = self.w2i[EOS_TOKEN]
+        return lang_idx, lang_len
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    import torch
+
+    parser = ArgumentParser(
+        description='Convert npz shards to memory-mappable npy shards',
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('files', nargs='+', help='npz shards to convert')
+    parser.add_argument('--vocab', default='./models/shapeworld/vocab.pt',
+                        help='Vocab used to pre-tokenize language')
+    parser.add_argument('--palette', action='store_true',
+                        help='Store images as a palette index image')
+    args = parser.parse_args()
+
+    vocab = torch.load(args.vocab)
+    for file in args.files:
+        print(convert_to_mmap(file, vocab, palette=args.palette))
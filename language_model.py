@@ -22,6 +22,7 @@ import util
 from data import ShapeWorld
 from run import run
 import data
+import manifest
 from shapeworld import SHAPES, COLORS, VOCAB
 
 def init_metrics():
@@ -53,15 +54,8 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', default='single')
     args = parser.parse_args()
     
-    if args.dataset == 'single':
-        language_model_data = ['./data/single/reference-1000-55.npz','./data/single/reference-1000-56.npz','./data/single/reference-1000-57.npz','./data/single/reference-1000-58.npz','./data/single/reference-1000-59.npz']
-    elif args.dataset == 'chairs':
-        language_model_data = ['./data/'+args.dataset+'/data_1000_0.npz','./data/'+args.dataset+'/data_1000_1.npz','./data/'+args.dataset+'/data_1000_2.npz','./data/'+args.dataset+'/data_1000_3.npz','./data/'+args.dataset+'/data_1000_4.npz','./data/'+args.dataset+'/data_1000_5.npz','./data/'+args.dataset+'/data_1000_6.npz','./data/'+args.dataset+'/data_1000_7.npz','./data/'+args.dataset+'/data_1000_8.npz','./data/'+args.dataset+'/data_1000_9.npz','./data/'+args.dataset+'/data_1000_10.npz','./data/'+args.dataset+'/data_1000_11.npz','./data/'+args.dataset+'/data_1000_12.npz','./data/'+args.dataset+'/data_1000_13.npz','./data/'+args.dataset+'/data_1000_14.npz','./data/'+args.dataset+'/data_1000_15.npz','./data/'+args.dataset+'/data_1000_16.npz','./data/'+args.dataset+'/data_1000_17.npz','./data/'+args.dataset+'/data_1000_18.npz','./data/'+args.dataset+'/data_1000_19.npz','./data/'+args.dataset+'/data_1000_20.npz','./data/'+args.dataset+'/data_1000_21.npz','./data/'+args.dataset+'/data_1000_22.npz','./data/'+args.dataset+'/data_1000_23.npz','./data/'+args.dataset+'/data_1000_24.npz','./data/'+args.dataset+'/data_1000_25.npz','./data/'+args.dataset+'/data_1000_26.npz']
-    elif args.dataset == 'colors':
-        language_model_data = ['./data/'+args.dataset+'/data_1000_0.npz','./data/'+args.dataset+'/data_1000_1.npz','./data/'+args.dataset+'/data_1000_2.npz','./data/'+args.dataset+'/data_1000_3.npz','./data/'+args.dataset+'/data_1000_4.npz','./data/'+args.dataset+'/data_1000_5.npz','./data/'+args.dataset+'/data_1000_6.npz','./data/'+args.dataset+'/data_1000_7.npz','./data/'+args.dataset+'/data_1000_8.npz','./data/'+args.dataset+'/data_1000_9.npz','./data/'+args.dataset+'/data_1000_10.npz','./data/'+args.dataset+'/data_1000_11.npz','./data/'+args.dataset+'/data_1000_12.npz','./data/'+args.dataset+'/data_1000_13.npz','./data/'+args.dataset+'/data_1000_14.npz','./data/'+args.dataset+'/data_1000_15.npz','./data/'+args.dataset+'/data_1000_16.npz','./data/'+args.dataset+'/data_1000_17.npz','./data/'+args.dataset+'/data_1000_18.npz','./data/'+args.dataset+'/data_1000_19.npz','./data/'+args.dataset+'/data_1000_20.npz','./data/'+args.dataset+'/data_1000_21.npz','./data/'+args.dataset+'/data_1000_22.npz','./data/'+args.dataset+'/data_1000_23.npz','./data/'+args.dataset+'/data_1000_24.npz','./data/'+args.dataset+'/data_1000_25.npz','./data/'+args.dataset+'/data_1000_26.npz','./data/'+args.dataset+'/data_1000_27.npz','./data/'+args.dataset+'/data_1000_28.npz','./data/'+args.dataset+'/data_1000_29.npz','./data/'+args.dataset+'/data_1000_30.npz','./data/'+args.dataset+'/data_1000_31.npz','./data/'+args.dataset+'/data_1000_32.npz','./data/'+args.dataset+'/data_1000_33.npz','./data/'+args.dataset+'/data_1000_34.npz','./data/'+args.dataset+'/data_1000_35.npz','./data/'+args.dataset+'/data_1000_36.npz','./data/'+args.dataset+'/data_1000_37.npz','./data/'+args.dataset+'/data_1000_38.npz','./data/'+args.dataset+'/data_1000_39.npz','./data/'+args.dataset+'/data_1000_40.npz','./data/'+args.dataset+'/data_1000_41.npz','./data/'+args.dataset+'/data_1000_42.npz','./data/'+args.dataset+'/data_1000_43.npz','./data/'+args.dataset+'/data_1000_44.npz','./data/'+args.dataset+'/data_1000_45.npz']
-    elif args.dataset == "shapeworld":
-        # i guess, for pretraining?
-        language_model_data = [f"data/shapeworld/reference-1000-{x}.npz" for x in range(60,65)]
+    # Shards with the language_model role in the dataset's manifest (built on first use)
+    language_model_data = manifest.shards('./data/'+args.dataset, 'language_model', args.dataset)
         
     # Vocab
     vocab = torch.load('./models/'+str(args.dataset)+'/vocab.pt')
@@ -0,0 +1,244 @@
+"""
+Shard manifests: a ``manifest.json`` per data directory recording each
+shard's game count, size, checksum, split roles and config distribution, so
+that file lists, epoch plans and worker allocations never need to open an npz
+"""
+
+import hashlib
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+from shapeworld import COLORS, SHAPES
+
+MANIFEST = 'manifest.json'
+RELATIONS = ['left', 'right', 'above', 'below']
+
+# Shard naming and split roles per dataset (shard indices per role). A shard
+# can serve several roles, e.g. shapeworld listeners are pretrained on the
+# same shards the speakers train on.
+LAYOUTS = {
+    'shapeworld': {
+        'pattern': 'reference-1000-{}.npz',
+        'n_shards': 75,
+        'roles': {
+            'pretrain': list(range(55)) + list(range(70, 75)),
+            'train': list(range(30)),
+            'val': list(range(65, 70)),
+            'language_model': list(range(60, 65)),
+        },
+    },
+    'shapeworld_generalization': {
+        'pattern': 'reference-1000-{}.npz',
+        'n_shards': 75,
+        'roles': {
+            'pretrain': list(range(10)),
+            'train': list(range(30)),
+            'val': list(range(65, 70)),
+        },
+    },
+    'single': {
+        'pattern': 'reference-1000-{}.npz',
+        'n_shards': 60,
+        'roles': {'language_model': list(range(55, 60))},
+    },
+    'colors': {
+        'pattern': 'data_1000_{}.npz',
+        'n_shards': 46,
+        'roles': {
+            'pretrain': list(range(45)),
+            'train': list(range(15)),
+            'val': list(range(15, 30)),
+            'language_model': list(range(46)),
+        },
+    },
+    'chairs': {
+        'pattern': 'data_1000_{}.npz',
+        'n_shards': 27,
+        'roles': {'language_model': list(range(27))},
+    },
+}
+
+
+def layout_roles(layout, index):
+    """Split roles of shard number ``index`` under ``LAYOUTS[layout]``."""
+    return [role for role, idx in LAYOUTS[layout]['roles'].items() if index in idx]
+
+
+def checksum(path, chunk_size=1 << 20):
+    """sha1 of a file, read in chunks."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def config_counts(langs):
+    """Distribution of shape colors, shapes and spatial relations in ``langs``."""
+    counts = {'color': Counter(), 'shape': Counter(), 'spatial': Counter()}
+    for lang in langs:
+        toks = str(lang).lower().split()
+        counts['color'].update(t for t in toks if t in COLORS)
+        counts['shape'].update(t for t in toks if t in SHAPES)
+        counts['spatial'].update(t for t in toks if t in RELATIONS)
+    return {k: dict(sorted(v.items())) for k, v in counts.items()}
+
+
+def shard_entry(path, data=None, roles=None):
+    """
+    Manifest entry for one shard.
+    Parameters
+    ----------
+    path : ``str``
+        Path to the npz shard
+    data : ``dict``, optional (default: None)
+        The arrays just written to ``path``; if None the shard is opened once
+    roles : ``list``, optional (default: None)
+        Split roles of the shard, e.g. ``['train']``
+    """
+    if data is None:
+        data = np.load(path)
+    return {
+        'n': int(len(data['labels'])),
+        'bytes': os.path.getsize(path),
+        'sha1': checksum(path),
+        'roles': list(roles or []),
+        'configs': config_counts(data['langs']),
+    }
+
+
+def load_manifest(data_dir):
+    """Manifest of ``data_dir``, or an empty one if it has not been written."""
+    path = os.path.join(data_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {'shards': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(data_dir, manifest):
+    path = os.path.join(data_dir, MANIFEST)
+    # Write then rename, so readers never see a partial manifest
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def add_shard(path, data=None, roles=None):
+    """Record (or refresh) the entry for ``path`` in its directory's manifest."""
+    data_dir, name = os.path.split(path)
+    manifest = load_manifest(data_dir)
+    manifest['shards'][name] = shard_entry(path, data, roles)
+    save_manifest(data_dir, manifest)
+    return manifest
+
+
+def build_manifest(data_dir, layout):
+    """Index the existing shards of ``data_dir`` laid out as ``LAYOUTS[layout]``."""
+    spec = LAYOUTS[layout]
+    manifest = {'layout': layout, 'shards': {}}
+    for i in range(spec['n_shards']):
+        name = spec['pattern'].format(i)
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            manifest['shards'][name] = shard_entry(path, roles=layout_roles(layout, i))
+    save_manifest(data_dir, manifest)
+    return manifest
+
+
+def _shard_number(name):
+    digits = ''.join(c if c.isdigit() else ' ' for c in name).split()
+    return int(digits[-1]) if digits else -1
+
+
+def shards(data_dir, role=None, layout=None):
+    """
+    Shard paths of ``data_dir`` (optionally only those with ``role``), in
+    shard number order. If the directory has no manifest yet and ``layout`` is
+    given, one is built first.
+    """
+    manifest = load_manifest(data_dir)
+    if not manifest['shards'] and layout is not None:
+        manifest = build_manifest(data_dir, layout)
+    names = [
+        name for name, entry in manifest['shards'].items()
+        if role is None or role in entry['roles']
+    ]
+    return [os.path.join(data_dir, name) for name in sorted(names, key=_shard_number)]
+
+
+def groups(files, size):
+    """Split ``files`` into consecutive groups of ``size`` (e.g. per pretrained listener)."""
+    return [files[i:i + size] for i in range(0, len(files), size)]
+
+
+def entries(data_files):
+    """Manifest entries for ``data_files``, reading each directory's manifest once."""
+    manifests = {}
+    out = []
+    for path in data_files:
+        data_dir, name = os.path.split(path)
+        if data_dir not in manifests:
+            manifests[data_dir] = load_manifest(data_dir)
+        if name not in manifests[data_dir]['shards']:
+            raise KeyError(f'{path} is not in {os.path.join(data_dir, MANIFEST)}')
+        out.append(manifests[data_dir]['shards'][name])
+    return out
+
+
+def plan_epoch(data_files, batch_size, seed=None):
+    """
+    Shard order and batch counts for one epoch.
+    Parameters
+    ----------
+    data_files : ``list``
+        Shard paths with manifest entries
+    batch_size : ``int``
+        Games per batch
+    seed : ``int``, optional (default: None)
+        Shuffle the shard order with this seed; None keeps the given order
+    Returns
+    -------
+    plan : ``list``
+        ``(path, n_games, n_batches)`` per shard, in visiting order
+    """
+    ns = [e['n'] for e in entries(data_files)]
+    order = np.arange(len(data_files))
+    if seed is not None:
+        order = np.random.RandomState(seed).permutation(len(data_files))
+    return [(data_files[i], ns[i], -(-ns[i] // batch_size)) for i in order]
+
+
+def allocate(data_files, n_workers):
+    """
+    Assign shards to ``n_workers`` so that each gets about the same number of
+    games (largest shard first to the least loaded worker).
+    Returns
+    -------
+    assignment : ``list``
+        One list of shard paths per worker
+    """
+    ns = [e['n'] for e in entries(data_files)]
+    loads = [0] * n_workers
+    assignment = [[] for _ in range(n_workers)]
+    for i in sorted(range(len(data_files)), key=lambda i: -ns[i]):
+        w = loads.index(min(loads))
+        assignment[w].append(data_files[i])
+        loads[w] += ns[i]
+    return assignment
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(description='Index a directory of shards',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('data_dir')
+    parser.add_argument('--layout', default='shapeworld', choices=sorted(LAYOUTS))
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.data_dir, args.layout)
+    print(f"Indexed {len(manifest['shards'])} shards in {os.path.join(args.data_dir, MANIFEST)}")
@@ -21,6 +21,7 @@ class FeatureMLP(nn.Module):
         )
         self.input_size = input_size
         self.output_size = output_size
+        self.final_feat_dim = output_size
 
     def forward(self, x):
         return self.trunk(x)
@@ -32,6 +33,25 @@ def to_onehot(y, n=3):
     return y_onehot
 
 
+def embed_tokens(embedding, seq):
+    """
+    Embed a token sequence. ``seq`` is either a LongTensor of token ids, which
+    is looked up directly, or a (possibly relaxed) one-hot FloatTensor over the
+    vocab, which is multiplied into the embedding matrix.
+    """
+    seq = seq.to(embedding.weight.device)
+    if seq.is_floating_point():
+        return seq @ embedding.weight
+    return embedding(seq)
+
+
+def token_log_probs(log_probs, seq):
+    """Log probabilities of the tokens in ``seq`` (ids or one-hot), over the last dim."""
+    if seq.is_floating_point():
+        return (log_probs * seq).sum(-1)
+    return log_probs.gather(-1, seq.unsqueeze(-1)).squeeze(-1)
+
+
 class Speaker(nn.Module):
     def __init__(self, feat_model, embedding_module, hidden_size=100):
         super(Speaker, self).__init__()
@@ -65,8 +85,16 @@ class Speaker(nn.Module):
         
         return ft_concat
 
-    def forward(self, feats, targets, greedy=False, activation='gumbel', tau = 1, length_penalty=False, max_len=40):
-        """Sample from image features"""
+    def forward(self, feats, targets, greedy=False, activation='gumbel', tau = 1, length_penalty=False, max_len=40, sync_every=4):
+        """
+        Sample from image features. Whether every sequence has finished is
+        only checked on the host every ``sync_every`` steps; steps taken after
+        that point are dropped again, so the samples do not depend on it.
+        At those checks the batch is also compacted: the GRU, output layer and
+        sampling only run on the rows still needed (unfinished, or finished
+        on the step before, whose last token is still scored), and their
+        results are scattered back into full-batch tensors.
+        """
         batch_size = feats.size(0)
 
         feats_emb = self.embed_features(feats, targets)
@@ -80,14 +108,28 @@ class Speaker(nn.Module):
         if length_penalty:
             eos_prob = []
             
-        if activation == 'multinomial':
-            lang_prob = []
-        else:
-            lang_prob = None
+        # Per step log probs: of the sampled token (multinomial), or as
+        # self.probability scores the sequence, of the token fed in
+        lang_prob = []
         
-        # And vector lengths
-        lang_length = torch.ones(batch_size, dtype=torch.int64).to(feats.device)
-        done_sampling = [False for _ in range(batch_size)]
+        # And vector lengths, kept on device
+        lang_length = torch.ones(batch_size, dtype=torch.int64, device=feats.device)
+        done_sampling = torch.zeros(batch_size, dtype=torch.bool, device=feats.device)
+        # Steps taken while some sequence was unfinished
+        n_steps = torch.zeros((), dtype=torch.int64, device=feats.device)
+        # done_sampling as of the step before, and the rows decoded (None: all)
+        was_done = done_sampling
+        active = None
+
+        def expand(x):
+            """(n_active, ...) -> (batch_size, ...), zeros in the rows not decoded"""
+            if active is None:
+                return x
+            return x.new_zeros((batch_size, ) + x.shape[1:]).index_copy(0, active, x)
+
+        # jeez...activation can be None, which defaults to gumbel behaviour
+        # but never stops sampling.
+        stops = activation in {'gumbel', 'multinomial'}
 
         # first input is SOS token
         # (batch_size, n_vocab)
@@ -106,16 +148,33 @@ class Speaker(nn.Module):
         # compute embeddings
         # (1, batch_size, n_vocab) X (n_vocab, h) -> (1, batch_size, h)
         inputs = inputs_onehot @ self.embedding.weight
+        # (inputs, states) before each step, to resume after the loop
+        history = [(inputs, states)]
 
         for i in range(max_len - 2):  # Have room for SOS, EOS if never sampled
             # FIXME: This is inefficient since I do sampling even if we've
             # finished generating language.
-            if all(done_sampling):
-                break
+            if i % sync_every == 0:
+                done_npy, was_done_npy = torch.stack((done_sampling, was_done)).cpu().numpy()
+                if done_npy.all():
+                    break
+                active = None
+                if was_done_npy.any():
+                    active = torch.from_numpy(np.flatnonzero(~was_done_npy)).to(feats.device)
+            was_done = done_sampling.clone()
+            n_steps += (~done_sampling).any()
+            if active is None:
+                inputs_a, states_a = inputs, states
+            else:
+                inputs_a, states_a = inputs[:, active], states[:, active]
             self.gru.flatten_parameters()
-            outputs, states = self.gru(inputs, states)  # outputs: (L=1,B,H)
-            outputs = outputs.squeeze(0)                # outputs: (B,H)
-            outputs = self.outputs2vocab(outputs)       # outputs: (B,V)
+            outputs, states_a = self.gru(inputs_a, states_a)  # outputs: (L=1,A,H)
+            states = states_a if active is None else states.index_copy(1, active, states_a)
+            outputs = outputs.squeeze(0)                # outputs: (A,H)
+            outputs = self.outputs2vocab(outputs)       # outputs: (A,V)
+            if activation != 'multinomial':
+                fed = lang[-1][:, 0] if active is None else lang[-1][active, 0]
+                lang_prob.append(expand(token_log_probs(F.log_softmax(outputs, dim=1), fed.detach())))
             
             if greedy:
                 predicted = outputs.max(1)[1]
@@ -137,29 +196,34 @@ class Speaker(nn.Module):
                     predicted = torch.multinomial(idx_prob.exp(), 1)
                     predicted_onehot = to_onehot(predicted, n=self.vocab_size)
                     predicted_logprob = torch.gather(idx_prob, 1, predicted)
-                    lang_prob.append(predicted_logprob)
+                    lang_prob.append(expand(predicted_logprob))
                 else:
                     raise NotImplementedError(activation)
                     
                 # Add to lang
+                predicted_a = predicted_onehot
+                predicted_onehot = expand(predicted_onehot)
                 lang.append(predicted_onehot.unsqueeze(1))
                 if length_penalty:
                     idx_prob = F.log_softmax(outputs, dim = 1)
-                    eos_prob.append(idx_prob[:,data.EOS_IDX])
+                    eos_prob.append(expand(idx_prob[:,data.EOS_IDX]))
 
-            predicted_npy = predicted_onehot.argmax(1).cpu().numpy()
-            
             # Update language lengths
-            for j, pred in enumerate(predicted_npy):
-                if not done_sampling[j]:
-                    lang_length[j] += 1
-                # jeez...activation can be None, which defaults to gumbel behaviour
-                # but fails here.
-                if pred == data.EOS_IDX and activation in {'gumbel', 'multinomial'}:
-                   done_sampling[j] = True
-
-            # (1, batch_size, n_vocab) X (n_vocab, h) -> (1, batch_size, h)
-            inputs = (predicted_onehot.unsqueeze(0)) @ self.embedding.weight
+            lang_length += (~done_sampling).long()
+            if stops:
+                done_sampling |= predicted_onehot.argmax(1) == data.EOS_IDX
+
+            # (1, A, n_vocab) X (n_vocab, h) -> (1, A, h), scattered to (1, batch_size, h)
+            inputs = expand(predicted_a @ self.embedding.weight).unsqueeze(0)
+            history.append((inputs, states))
+
+        # Drop the steps taken after every sequence had finished
+        n_steps = int(n_steps)
+        lang = lang[:n_steps + 1]
+        lang_prob = lang_prob[:n_steps]
+        inputs, states = history[n_steps]
+        if length_penalty:
+            eos_prob = eos_prob[:n_steps]
 
         # If multinomial, we need to run inputs once more to get the logprob of
         # EOS (in case we've sampled that far)
@@ -177,41 +241,44 @@ class Speaker(nn.Module):
         lang.append(eos_onehot)
         
         # Cut off the rest of the sentences
-        for i, _ in enumerate(predicted_npy):
-            if not done_sampling[i]:
-                lang_length[i] += 1
-            done_sampling[i] = True
+        lang_length += (~done_sampling).long()
 
         # Cat language tensors
         lang_tensor = torch.cat(lang, 1)
-        
-        for i in range(lang_tensor.shape[0]):
-            lang_tensor[i, lang_length[i]:] = 0
+
+        # (B, L) mask of the positions within each sequence
+        steps = torch.arange(lang_tensor.shape[1], device=lang_length.device)
+        in_seq = steps[None, :] < lang_length[:, None]
+        lang_tensor = lang_tensor.masked_fill(~in_seq[:, :, None], 0)
 
         # Trim max length
-        max_lang_len = lang_length.max()
+        max_lang_len = int(lang_length.max())
         lang_tensor = lang_tensor[:, :max_lang_len, :]
-        #import pdb; pdb.set_trace()
         
         if activation == 'multinomial':
             lang_prob_tensor = torch.cat(lang_prob, 1)
-            for i in range(lang_prob_tensor.shape[0]):
-                lang_prob_tensor[i, lang_length[i]:] = 0
+            lang_prob_tensor = lang_prob_tensor.masked_fill(~in_seq[:, :lang_prob_tensor.shape[1]], 0)
             lang_prob_tensor = lang_prob_tensor[:, :max_lang_len]
             lang_prob = lang_prob_tensor.sum(1)
         else:
-            # compute log prob of sampled language
-            # just recompute, easier
-            # probability of ALL tokens (zeroed out for things beyond lang_length)
-            lang_prob = self.probability(feats, lang_tensor, lang_length, targets)
+            # Score the last sampled token and the added EOS too, if some
+            # sequence is that long: one or two more steps instead of
+            # rerunning the whole sequence through self.probability
+            for t in range(n_steps, max_lang_len):
+                if t > n_steps:
+                    inputs = lang[t].transpose(0, 1) @ self.embedding.weight
+                self.gru.flatten_parameters()
+                outputs, states = self.gru(inputs, states)
+                outputs = self.outputs2vocab(outputs.squeeze(0))
+                lang_prob.append(token_log_probs(F.log_softmax(outputs, dim=1), lang[t][:, 0].detach()))
+            # (max_lang_len, B), zeroed out for things beyond lang_length
+            lang_prob = torch.stack(lang_prob).masked_fill(~in_seq[:, :max_lang_len].t(), 0)
         
         if length_penalty:
             # eos prob -> eos loss
             eos_prob = torch.stack(eos_prob, dim = 1)
-            for i in range(eos_prob.shape[0]):
-                r_len = torch.arange(1,eos_prob.shape[1]+1,dtype=torch.float32)
-                eos_prob[i] = eos_prob[i]*r_len.to(eos_prob.device)
-                eos_prob[i, lang_length[i]:] = 0
+            r_len = steps[:eos_prob.shape[1]] + 1
+            eos_prob = (eos_prob * r_len.float()).masked_fill(~in_seq[:, :eos_prob.shape[1]], 0)
             eos_loss = -eos_prob
             eos_loss = eos_loss.sum(1)/lang_length.float()
             eos_loss = eos_loss.mean()
@@ -322,8 +389,8 @@ class LiteralSpeaker(nn.Module):
         # reorder from (B,L,D) to (L,B,D)
         seq = seq.transpose(0, 1).to(feats.device)
 
-        # embed your sequences
-        embed_seq = seq @ self.embedding.weight
+        # embed your sequences (token ids or one-hot)
+        embed_seq = embed_tokens(self.embedding, seq)
             
         #feats_emb = self.feat_model(feats.squeeze().to(feats.device))
         feats_emb = self.init_h(feats_emb)
@@ -399,23 +466,28 @@ class LiteralSpeaker(nn.Module):
             B = y.shape[0]
             done_sampling = np.array([False for _ in range(B)])
             sampled_lens = np.zeros(B)
+            # Rows still sampling; finished ones are padded from then on
+            active = np.arange(B)
 
             for i in range(max_len-1):
+                act = torch.from_numpy(active).to(feats.device)
                 self.gru.flatten_parameters()
-                outputs, states = self.gru(inputs, states)  # outputs: (L=1,B,H)
-                outputs = outputs.squeeze(0)                # outputs: (B,H)
-                outputs = self.outputs2vocab(outputs)       # outputs: (B,V)
+                outputs, states_a = self.gru(inputs[:, act], states[:, act])  # outputs: (L=1,A,H)
+                states[:, act] = states_a
+                outputs = outputs.squeeze(0)                # outputs: (A,H)
+                outputs = self.outputs2vocab(outputs)       # outputs: (A,V)
 
                 if greedy:
-                    predicted = outputs.max(1)[1].cpu()
-                    predicted = predicted.unsqueeze(1)
+                    predicted_a = outputs.max(1)[1].cpu()
                 else:
                     outputs = F.softmax(outputs, dim=1)
-                    predicted = torch.multinomial(outputs.cpu(), 1)
+                    predicted_a = torch.multinomial(outputs.cpu(), 1).squeeze(1)
+                predicted = torch.full((B, 1), PAD_IDX, dtype=torch.long)
+                predicted[active, 0] = predicted_a
                     
                 predicted = predicted.transpose(0, 1)        # inputs: (L=1,B)
                 predicted = F.one_hot(predicted, num_classes=self.vocab_size).float()
-                inputs = predicted.to(feats.device) @ self.embedding.weight
+                inputs[:, act] = F.one_hot(predicted_a, num_classes=self.vocab_size).float().to(feats.device) @ self.embedding.weight
                 # inputs: (L=1,B,E)
                 
                 sampled = np.concatenate((sampled,predicted),axis = 0)
@@ -432,6 +504,7 @@ class LiteralSpeaker(nn.Module):
 
                 if done_sampling.all():
                     break
+                active = np.flatnonzero(~done_sampling)
             
             sampled = torch.tensor(sampled).permute(1,0,2)
             
@@ -446,12 +519,12 @@ class LiteralSpeaker(nn.Module):
     def probability(self, feats, seq, length, y):
         #max_len = 40
         #batch_size = seq.shape[0]
-        batch_size, max_len, V = seq.shape
+        batch_size, max_len = seq.shape[:2]
         #seq = F.pad(seq,(0,0,0,(max_len-seq.shape[1]))).float()
         # reorder from (B,L,D) to (L,B,D)
         seq = seq.transpose(0, 1)
-        # embed your sequences
-        embed_seq = seq.cuda() @ self.embedding.weight
+        # embed your sequences (token ids or one-hot)
+        embed_seq = embed_tokens(self.embedding, seq)
         # TODO: check if seq is relaxed
 
         if self.contextual:
@@ -486,11 +559,9 @@ class LiteralSpeaker(nn.Module):
         outputs = outputs.squeeze(0)
         outputs = self.outputs2vocab(outputs)
         
-        # seq is a binary mask, then sum over 1-hot vocabulary
+        # pick out log probs of the observed tokens, zeroed beyond length
         mask = torch.arange(max_len, device=length.device)[:,None] < length
-        masked_seq = seq * mask[:,:,None]
-        # sum over vocab (one-hot or zeroed out)
-        log_probs = (outputs.log_softmax(-1) * masked_seq).sum(-1)
+        log_probs = token_log_probs(outputs.log_softmax(-1), seq) * mask
 
         return log_probs
 
@@ -514,9 +585,8 @@ class LanguageModel(nn.Module):
         # reorder from (B,L,D) to (L,B,D)
         seq = seq.transpose(0, 1)
 
-        # embed your sequences
-        embed_seq = seq.cuda() @ self.embedding.weight
-        # TODO: check if inputs are relaxed
+        # embed your sequences (token ids or one-hot)
+        embed_seq = embed_tokens(self.embedding, seq)
         
         # shape = (seq_len, batch, hidden_dim)
         feats_emb = torch.zeros(1, batch_size, self.hidden_size).to(embed_seq.device)
@@ -569,12 +639,14 @@ class LanguageModel(nn.Module):
     def probability(self, seq, length):
         max_len = 40
         batch_size = seq.shape[0]
-        seq = F.pad(seq,(0,0,0,(max_len-seq.shape[1]))).float()
+        if seq.is_floating_point():
+            seq = F.pad(seq,(0,0,0,(max_len-seq.shape[1])))
+        else:
+            seq = F.pad(seq,(0,max_len-seq.shape[1]), value=PAD_IDX)
         # reorder from (B,L,D) to (L,B,D)
         seq = seq.transpose(0, 1)
-        # embed your sequences
-        embed_seq = seq.cuda() @ self.embedding.weight
-        # TODO: check if seq is relaxed
+        # embed your sequences (token ids or one-hot)
+        embed_seq = embed_tokens(self.embedding, seq)
 
         # shape = (seq_len, batch, hidden_dim)
         feats_emb = torch.zeros(1, batch_size, self.hidden_size).to(embed_seq.device)
@@ -588,17 +660,16 @@ class LanguageModel(nn.Module):
         outputs = outputs.squeeze(0)
         outputs = self.outputs2vocab(outputs)
 
-        # seq is a binary mask, then sum over 1-hot vocabulary
+        # pick out log probs of the observed tokens, zeroed beyond length
         mask = torch.arange(max_len, device=length.device)[:,None] < length
-        masked_seq = seq * mask[:,:,None]
-        # sum over vocab and time, normalize by length.
-        log_probs = (outputs.log_softmax(-1) * masked_seq).sum(-1)
+        log_probs = token_log_probs(outputs.log_softmax(-1), seq) * mask
 
         return log_probs
     
 class RNNEncoder(nn.Module):
     """
-    RNN Encoder - takes in onehot representations of tokens, rather than numeric
+    RNN Encoder - takes in token ids, or onehot representations of tokens
+    (e.g. gumbel-softmax samples)
     """
     def __init__(self, embedding_module, hidden_size=100):
         super(RNNEncoder, self).__init__()
@@ -617,9 +688,8 @@ class RNNEncoder(nn.Module):
         # reorder from (B,L,D) to (L,B,D)
         seq = seq.transpose(0, 1)
 
-        # embed your sequences
-        embed_seq = seq.cuda() @ self.embedding.weight
-        # TODO: check if seq is relaxed
+        # embed your sequences (token ids or one-hot)
+        embed_seq = embed_tokens(self.embedding, seq)
 
         packed = rnn_utils.pack_padded_sequence(
             embed_seq,
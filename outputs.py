@@ -15,13 +15,23 @@ import torch.optim as optim
 import models
 import vision
 import util
+import registry
 from data import ShapeWorld
 import data
 from shapeworld import SHAPES, COLORS
 from run import run
 from train import init_metrics
 
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description='Evaluate speakers on the evaluation conditions')
+parser.add_argument('--uint8_images', action='store_true', help='Keep images uint8 until they reach the model (cast to float on the device)')
+parser.add_argument('--pin_memory', action='store_true', help='Pin batches in host memory and copy them to the GPU asynchronously')
+args = parser.parse_args()
+
 get_inputs = False
+uint8_images = args.uint8_images
+pin_memory = args.pin_memory
 
 vocab = torch.load('./models/single/vocab.pt')
 print(vocab)
@@ -34,6 +44,8 @@ loss = nn.CrossEntropyLoss()
 metrics = init_metrics()
    
 batch_size = 100
+# Evaluation conditions; views written by views.py are rendered with the numpy
+# rasterizer, not aggdraw (~0.3% of pixels differ, see shapeworld.compare_backends)
 files = ['./data/single/random/reference-1000.npz','./data/single/both_needed/reference-1000.npz', './data/single/either_ok/reference-1000.npz','./data/single/shape_needed/reference-1000.npz','./data/single/color_needed/reference-1000.npz']
 output_files = ['./output/single/random/','./output/single/both_needed/','./output/single/either_ok/','./output/single/shape_needed/','./output/single/color_needed/']
 epoch = 0
@@ -48,9 +60,9 @@ activations = ['gumbel','gumbel','gumbel','gumbel','multinomial','gumbel']
 num_samples = [1,1,1,5,1,1]
 
 for listener, listener_name in zip(listeners, listener_names):
-    listener = torch.load(listener)
+    listener = registry.load_model(listener)
     for model, speaker, run_type, activation, n in zip(models,speakers,run_types,activations,num_samples):
-        speaker = torch.load(speaker)
+        speaker = registry.load_model(speaker)
         for (file, output_file) in zip(files,output_files):
-            metrics, _ = run(epoch, [file], 'test', run_type, speaker, listener, optimizer, loss, vocab, batch_size, True, num_samples = n, activation = activation)
+            metrics, _ = run(epoch, [file], 'test', run_type, speaker, listener, optimizer, loss, vocab, batch_size, True, num_samples = n, activation = activation, uint8_images = uint8_images, pin_memory = pin_memory)
             np.save(output_file+str(model)+'_'+str(listener_name)+'_metrics.npy', metrics)
\ No newline at end of file
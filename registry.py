@@ -0,0 +1,50 @@
+"""
+Process-wide cache of pretrained checkpoints
+"""
+
+import os
+
+import torch
+
+# abspath -> (mtime, model)
+_MODELS = {}
+
+
+def load_model(path):
+    """
+    Load a pickled model checkpoint once per process.
+
+    Models are keyed by path and modification time, so a checkpoint that is
+    rewritten on disk (e.g. by a training run in another process) is picked up
+    on the next call. The same instance is handed to every caller, so it is
+    frozen and put back in eval mode on every call; callers that need
+    gradients to flow *through* a model (e.g. cudnn RNN backward) may toggle
+    ``.train()`` temporarily but must call ``reset_modes`` when done.
+
+    Parameters
+    ----------
+    path : ``str``
+        Path to a checkpoint written with ``torch.save(model, path)``
+    """
+    key = os.path.abspath(path)
+    mtime = os.path.getmtime(key)
+    cached = _MODELS.get(key)
+    if cached is not None and cached[0] == mtime:
+        model = cached[1]
+    else:
+        model = torch.load(key)
+        _MODELS[key] = (mtime, model)
+    model.requires_grad_(False)
+    model.eval()
+    return model
+
+
+def reset_modes():
+    """Put every cached model back in eval mode."""
+    for _, model in _MODELS.values():
+        model.eval()
+
+
+def clear():
+    """Drop all cached models."""
+    _MODELS.clear()
@@ -16,6 +16,7 @@ import torch.optim as optim
 import models
 import vision
 import util
+import registry
 from data import ShapeWorld
 import data
     
@@ -33,6 +34,8 @@ def _collect_outputs(meters, outputs, vocab, img, y, lang, lang_length, lis_pred
         #seq_prob.append(np.exp(prob))
     # cast to device just in case, since sampling seems to be done on cpu
     seq_log_prob = language_model.probability(lang.to(y.device), lang_length.to(y.device)).sum()
+    if lang.dim() == 3:
+        lang = lang.argmax(2)
     num_toks = lang_length.sum().item()
         
     if ci_listeners != None:
@@ -42,7 +45,6 @@ def _collect_outputs(meters, outputs, vocab, img, y, lang, lang_length, lis_pred
             acc = correct.float().mean().item()
             ci.append(acc)
 
-    lang = lang.argmax(2)
     outputs['lang'].append(lang)
     outputs['pred'].append(lis_pred)
     outputs['score'].append(lis_scores)
@@ -86,32 +88,50 @@ def _generate_utterance(token_1, token_2, batch_size, max_len):
     lang_length = lang_length.unsqueeze(0)
     return lang, lang_length
 
-def run(data_file, split, model_type, speaker, listener, optimizer, loss, vocab, batch_size, cuda, num_samples = None, srr = True, lmbd = None, test_type = None, activation = 'gumbel', ci = True, dataset = 'shapeworld', penalty = None, tau = 1, generalization = None, debug = False):
+def _pinned(batch):
+    return tuple(torch.from_numpy(x).pin_memory() for x in batch)
+
+def _shard_batches(data_file, split, vocab, batch_size, prefetch, shuffle_buffer, seed, pin_memory, color_features=None):
+    """Yield, per shard, an iterable of (img, y, lang) batches."""
+    if isinstance(data_file, data.ProceduralShapeWorld):
+        # games are generated on the fly; seed picks the epoch
+        yield data_file.loader(batch_size, epoch=seed, pin_memory=pin_memory)
+    elif split == 'train' and shuffle_buffer:
+        # a single stream that mixes games across shards
+        batches = data.shuffled_batches(data_file, vocab, batch_size, buffer_size=shuffle_buffer, seed=seed, prefetch=prefetch, features=color_features)
+        if pin_memory:
+            yield (_pinned(batch) for batch in batches)
+        else:
+            yield (tuple(torch.from_numpy(x) for x in batch) for batch in batches)
+    else:
+        # next shards are loaded in the background while this one is consumed
+        for shard in data.prefetch_shards(data_file, vocab, depth=prefetch, features=color_features):
+            # one __getitem__ call per batch, returning array slices
+            yield DataLoader(shard, batch_size=None, sampler=data.BatchSlices(len(shard), batch_size), pin_memory=pin_memory)
+
+def run(data_file, split, model_type, speaker, listener, optimizer, loss, vocab, batch_size, cuda, num_samples = None, srr = True, lmbd = None, test_type = None, activation = 'gumbel', ci = True, dataset = 'shapeworld', penalty = None, tau = 1, generalization = None, debug = False, prefetch = 2, shuffle_buffer = None, seed = None, uint8_images = False, pin_memory = False, color_features = None):
     max_len = 40
     
     if model_type == 'sample' or model_type == 'rsa':
         if generalization == None:
-            internal_listener = torch.load('./models/'+dataset+'/literal_listener_0.pt')
+            internal_listener = registry.load_model('./models/'+dataset+'/literal_listener_0.pt')
         else:
-            internal_listener = torch.load('./models/'+dataset+'/'+generalization+'_literal_listener_0.pt')
+            internal_listener = registry.load_model('./models/'+dataset+'/'+generalization+'_literal_listener_0.pt')
 
     # comes from language_model.py. p(u)
-    language_model = torch.load('./models/'+dataset+'/language-model.pt')
+    # registry models are cached across calls, frozen and in eval mode
+    language_model = registry.load_model('./models/'+dataset+'/language-model.pt')
     # load pretrained literal speaker
-    s0 = torch.load('./models/'+dataset+'/literal_speaker.pt')
-    sc = torch.load('./models/'+dataset+'/conditional_speaker.pt')
+    s0 = registry.load_model('./models/'+dataset+'/literal_speaker.pt')
+    sc = registry.load_model('./models/'+dataset+'/conditional_speaker.pt')
 
     if split == 'train':
-        for param in language_model.parameters():
-            param.requires_grad = False
+        # gradients still flow through these to the sampled language,
+        # and cudnn RNN backward needs train mode
         language_model.train()
 
         # literal speaker for amortized speaker
-        for param in s0.parameters():
-            param.requires_grad = False
         s0.train()
-        for param in sc.parameters():
-            param.requires_grad = False
         sc.train()
 
         if model_type == 's0' or model_type == 'language_model':
@@ -140,7 +160,7 @@ def run(data_file, split, model_type, speaker, listener, optimizer, loss, vocab,
     if split == 'test':
         if ci == True:
             listener_dir = './models/shapeworld/literal_listener_'
-            ci_listeners = [torch.load(listener_dir+'2.pt'), torch.load(listener_dir+'3.pt'), torch.load(listener_dir+'4.pt'), torch.load(listener_dir+'5.pt'), torch.load(listener_dir+'6.pt'), torch.load(listener_dir+'7.pt'), torch.load(listener_dir+'8.pt'), torch.load(listener_dir+'9.pt'), torch.load(listener_dir+'10.pt')]
+            ci_listeners = [registry.load_model(listener_dir+f'{x}.pt') for x in range(2, 11)]
             for ci_listener in ci_listeners:
                 ci_listener.eval()
             # lol...?
@@ -157,325 +177,329 @@ def run(data_file, split, model_type, speaker, listener, optimizer, loss, vocab,
             measures = ['loss', 'lm loss', 'acc', 'length']
         meters = {m: util.AverageMeter() for m in measures}
 
-    with context:
-        for file in data_file:
-            d = data.load_raw_data(file)
-            if split == 'test':
-                dataloader = DataLoader(ShapeWorld(d, vocab), batch_size=batch_size, shuffle=False)
-            else:
-                dataloader = DataLoader(ShapeWorld(d, vocab), batch_size=batch_size, shuffle=False)
+    try:
+        with context:
+            for dataloader in _shard_batches(data_file, split, vocab, batch_size, prefetch, shuffle_buffer, seed, cuda and pin_memory, color_features):
+                for batch_i, (img, y, lang) in enumerate(dataloader):
+                    text = lang
+                    batch_size = img.shape[0] 
                 
-            for batch_i, (img, y, lang) in enumerate(dataloader):
-                text = lang
-                batch_size = img.shape[0] 
-                
-                # Reformat inputs
-                y = y.argmax(1) # convert from onehot
-                img = img.float() # convert to float
-                gt_lang = lang
-                if split == 'test':
-                    outputs['gt_lang'].append(gt_lang)
-                if model_type == 's0' or model_type == 'l0' or model_type == 'language_model' or model_type == 'oracle':
-                    max_len = 40
-                    length = torch.tensor([np.count_nonzero(t) for t in lang.cpu()], dtype=np.int)
-                    lang[lang>=len(vocab['w2i'].keys())] = 3
-                    lang = F.one_hot(lang, num_classes = len(vocab['w2i'].keys()))
-                    lang = F.pad(lang,(0,0,0,max_len-lang.shape[1])).float()
-                    for B in range(lang.shape[0]):
-                        for L in range(lang.shape[1]):
-                            if lang[B][L].sum() == 0:
-                                lang[B][L][0] = 1
-                                
-                if cuda:
-                    img = img.cuda()
-                    y = y.cuda()
-                    lang = lang.cuda()
-                    if model_type == 's0' or model_type == 'l0' or model_type == 'language_model':
-                        length = length.cuda()
+                    # Reformat inputs
+                    y = y.argmax(1) # convert from onehot
+                    if not uint8_images:
+                        img = img.float() # convert to float
+                    # else ship uint8 to the device; vision.ConvNet casts it
+                    gt_lang = lang
+                    if split == 'test':
+                        outputs['gt_lang'].append(gt_lang)
+                    if model_type == 's0' or model_type == 'l0' or model_type == 'language_model' or model_type == 'oracle':
+                        max_len = 40
+                        # models take token ids directly; one-hot is only needed
+                        # for gumbel relaxations
+                        length = (lang != data.PAD_IDX).sum(1)
+                        # not in place: batches may be views of the (mmap) shard
+                        lang = lang.masked_fill(lang>=len(vocab['w2i'].keys()), data.UNK_IDX)
+                        lang = F.pad(lang,(0,max_len-lang.shape[1]), value=data.PAD_IDX)
 
-                # Refresh the optimizer
-                if split == 'train':
-                    optimizer.zero_grad()
+                    if cuda:
+                        img = img.cuda(non_blocking=pin_memory)
+                        y = y.cuda()
+                        lang = lang.cuda()
+                        if model_type == 's0' or model_type == 'l0' or model_type == 'language_model':
+                            length = length.cuda()
 
-                # Forward pass
-                start = time.time()
-                if model_type == 'l0':
-                    lis_scores = listener(img, lang, length)
-                elif model_type == 's0':
-                    lang_out = speaker(img, lang, length, y)
-                elif model_type == 'language_model':
-                    lang_out = speaker(lang, length)
-                elif model_type == 'sample':
-                    if num_samples == 1:
-                        lang, lang_length = speaker.sample(img, y)
-                    else:
-                        if srr:
-                            langs, lang_lengths = speaker.sample(img, y)
+                    # Refresh the optimizer
+                    if split == 'train':
+                        optimizer.zero_grad()
+
+                    # Forward pass
+                    start = time.time()
+                    if model_type == 'l0':
+                        lis_scores = listener(img, lang, length)
+                    elif model_type == 's0':
+                        lang_out = speaker(img, lang, length, y)
+                    elif model_type == 'language_model':
+                        lang_out = speaker(lang, length)
+                    elif model_type == 'sample':
+                        if num_samples == 1:
+                            lang, lang_length = speaker.sample(img, y)
                         else:
-                            langs, lang_lengths, eos_loss = speaker(img, y)
-                        langs = langs.unsqueeze(0); lang_lengths = lang_lengths.unsqueeze(0)
-                        for _ in range(num_samples-1):
                             if srr:
-                                lang, lang_length = speaker.sample(img, y)
-                            else:
-                                lang, lang_length, eos_loss = speaker(img, y)
-                            lang = lang.unsqueeze(0); lang_length = lang_length.unsqueeze(0)
-                            langs = torch.cat((langs, lang), 0)
-                            lang_lengths = torch.cat((lang_lengths, lang_length), 0)
-                        lang = langs[:,0]
-                elif model_type == 'rsa':
-                    langs = 0
-                    lang_lengths = 0
-                    for color in [4, 6, 9, 10, 11, 14, 0]:
-                        for shape in [7, 8, 12, 13, 5, 0]:
-                            if color == 0:
-                                if shape != 0:
-                                    lang, lang_length = _generate_utterance(shape, None, batch_size, max_len)
-                            elif shape == 0:
-                                lang, lang_length = _generate_utterance(color, None, batch_size, max_len)
+                                langs, lang_lengths = speaker.sample(img, y)
                             else:
-                                lang0, lang_length0 = _generate_utterance(color, shape, batch_size, max_len)
-                                lang1, lang_length1 = _generate_utterance(shape, color, batch_size, max_len)       
-                                lang = torch.cat((lang0.unsqueeze(0), lang1.unsqueeze(0)), 0)
-                                lang_length = torch.cat((lang_length0.unsqueeze(0), lang_length1.unsqueeze(0)), 0)
-                            try:
+                                langs, lang_lengths, eos_loss = speaker(img, y)
+                            langs = langs.unsqueeze(0); lang_lengths = lang_lengths.unsqueeze(0)
+                            for _ in range(num_samples-1):
+                                if srr:
+                                    lang, lang_length = speaker.sample(img, y)
+                                else:
+                                    lang, lang_length, eos_loss = speaker(img, y)
+                                lang = lang.unsqueeze(0); lang_length = lang_length.unsqueeze(0)
                                 langs = torch.cat((langs, lang), 0)
                                 lang_lengths = torch.cat((lang_lengths, lang_length), 0)
-                            except:
-                                langs = lang
-                                lang_lengths = lang_length
-                    import pdb; pdb.set_trace()
-                    # whats going on with rsa
-                elif model_type == 'amortized':
-                    if penalty == None or penalty == "bayes" or penalty == "map":
-                        lang, lang_length, eos_loss, lang_prob = speaker(img, y, activation = activation, tau = tau, length_penalty = False)
-                    elif penalty == "length":
-                        lang, lang_length, eos_loss, lang_prob = speaker(img, y, activation = activation, tau = tau, length_penalty = True)
-                    else:
-                        raise ValueError(f"Unknown penalty: {penalty}")
-                    #import pdb; pdb.set_trace()
-                elif model_type == 'test':
-                    langs = torch.zeros(batch_size, max_len, len(vocab['w2i'].keys()))
-                    for i in range(len(lang)):
-                        color = lang[i,1]
-                        shape = lang[i,2]
-                        if test_type == 'color':
-                            langs, lang_lengths = _generate_utterance(color, None, batch_size, max_len)
-                        elif test_type == 'shape':
-                            langs, lang_lengths = _generate_utterance(shape, None, batch_size, max_len)
-                        elif test_type == 'color-shape':
-                            langs, lang_lengths = _generate_utterance(color, shape, batch_size, max_len)
+                            lang = langs[:,0]
+                    elif model_type == 'rsa':
+                        langs = 0
+                        lang_lengths = 0
+                        for color in [4, 6, 9, 10, 11, 14, 0]:
+                            for shape in [7, 8, 12, 13, 5, 0]:
+                                if color == 0:
+                                    if shape != 0:
+                                        lang, lang_length = _generate_utterance(shape, None, batch_size, max_len)
+                                elif shape == 0:
+                                    lang, lang_length = _generate_utterance(color, None, batch_size, max_len)
+                                else:
+                                    lang0, lang_length0 = _generate_utterance(color, shape, batch_size, max_len)
+                                    lang1, lang_length1 = _generate_utterance(shape, color, batch_size, max_len)       
+                                    lang = torch.cat((lang0.unsqueeze(0), lang1.unsqueeze(0)), 0)
+                                    lang_length = torch.cat((lang_length0.unsqueeze(0), lang_length1.unsqueeze(0)), 0)
+                                try:
+                                    langs = torch.cat((langs, lang), 0)
+                                    lang_lengths = torch.cat((lang_lengths, lang_length), 0)
+                                except:
+                                    langs = lang
+                                    lang_lengths = lang_length
+                        import pdb; pdb.set_trace()
+                        # whats going on with rsa
+                    elif model_type == 'amortized':
+                        if penalty == None or penalty == "bayes" or penalty == "map":
+                            lang, lang_length, eos_loss, lang_prob = speaker(img, y, activation = activation, tau = tau, length_penalty = False)
+                        elif penalty == "length":
+                            lang, lang_length, eos_loss, lang_prob = speaker(img, y, activation = activation, tau = tau, length_penalty = True)
                         else:
-                            langs, lang_lengths = _generate_utterance(shape, color, batch_size, max_len)
-                    langs = langs.unsqueeze(0)
-                    lang_lengths = lang_lengths.unsqueeze(0)
-                elif model_type == 'oracle':
-                    lang_length = length
-                else:
-                    lang, lang_length, eos_loss, lang_prob = speaker(img, y, activation = activation, tau = tau)
+                            raise ValueError(f"Unknown penalty: {penalty}")
+                        #import pdb; pdb.set_trace()
+                    elif model_type == 'test':
+                        langs = torch.zeros(batch_size, max_len, len(vocab['w2i'].keys()))
+                        for i in range(len(lang)):
+                            color = lang[i,1]
+                            shape = lang[i,2]
+                            if test_type == 'color':
+                                langs, lang_lengths = _generate_utterance(color, None, batch_size, max_len)
+                            elif test_type == 'shape':
+                                langs, lang_lengths = _generate_utterance(shape, None, batch_size, max_len)
+                            elif test_type == 'color-shape':
+                                langs, lang_lengths = _generate_utterance(color, shape, batch_size, max_len)
+                            else:
+                                langs, lang_lengths = _generate_utterance(shape, color, batch_size, max_len)
+                        langs = langs.unsqueeze(0)
+                        lang_lengths = lang_lengths.unsqueeze(0)
+                    elif model_type == 'oracle':
+                        lang_length = length
+                    else:
+                        lang, lang_length, eos_loss, lang_prob = speaker(img, y, activation = activation, tau = tau)
 
-                # Evaluate loss and accuracy
-                if model_type == 'l0':
-                    this_loss = loss(lis_scores, y)
-                    lis_pred = lis_scores.argmax(1)
-                    this_acc = (lis_pred == y).float().mean().item()
+                    # Evaluate loss and accuracy
+                    if model_type == 'l0':
+                        this_loss = loss(lis_scores, y)
+                        lis_pred = lis_scores.argmax(1)
+                        this_acc = (lis_pred == y).float().mean().item()
                     
-                    if split == 'train':
-                        # SGD step
-                        this_loss.backward()
-                        optimizer.step()
-                    """    
-                    # ...?
-                    if split == "train":   
+                        if split == 'train':
+                            # SGD step
+                            this_loss.backward()
+                            optimizer.step()
+                        """    
+                        # ...?
+                        if split == "train":   
+                            meters['loss'].update(this_loss, batch_size)
+                            meters['acc'].update(this_acc, batch_size)
+                        else:
+                            meters['loss'].append(this_loss)
+                            meters['acc'].append(this_acc)
+                        """
                         meters['loss'].update(this_loss, batch_size)
                         meters['acc'].update(this_acc, batch_size)
-                    else:
-                        meters['loss'].append(this_loss)
-                        meters['acc'].append(this_acc)
-                    """
-                    meters['loss'].update(this_loss, batch_size)
-                    meters['acc'].update(this_acc, batch_size)
-                elif model_type == 's0' or model_type == 'language_model':
-                    lang_out = lang_out[:, :-1].contiguous()
-                    lang = lang[:, 1:].contiguous()
-                    # this seems correct
-
-                    V = len(vocab['w2i'].keys())
-                    # compute NLL
-                    nll = -(lang_out.log_softmax(-1) * lang).sum(-1)
-                    mask = torch.arange(lang.shape[1], device=length.device)[None] < length[:,None]
-                    this_loss = (nll * mask).sum(-1).mean()
+                    elif model_type == 's0' or model_type == 'language_model':
+                        lang_out = lang_out[:, :-1].contiguous()
+                        lang = lang[:, 1:].contiguous()
+                        # this seems correct
 
-                    #lang_out = lang_out.view(batch_size*lang_out.size(1), )
-                    #lang = lang.long().view(batch_size*lang.size(1), len(vocab['w2i'].keys()))
-                    #this_loss = loss(lang_out.cuda(), torch.max(lang, 1)[1].cuda())
+                        V = len(vocab['w2i'].keys())
+                        # compute NLL
+                        nll = -models.token_log_probs(lang_out.log_softmax(-1), lang)
+                        mask = torch.arange(lang.shape[1], device=length.device)[None] < length[:,None]
+                        this_loss = (nll * mask).sum(-1).mean()
 
-                    if split == 'train':
-                        # SGD step
-                        this_loss.backward()
-                        optimizer.step()
-                        
-                    this_acc = (lang_out.argmax(1)==lang.argmax(1)).float().mean().item()
-
-                    meters['loss'].update(this_loss, batch_size)
-                    meters['acc'].update(this_acc, batch_size)
-                    # ...?
-                    """
-                    if split == "train":   
-                        meters['loss'].update(this_loss, batch_size)
-                        meters['acc'].update(this_acc, batch_size)
-                    else:
-                        meters['loss'].append(this_loss)
-                        meters['acc'].append(this_acc)
-                    """
-                else:
-                    if model_type == 'sample' or model_type == 'rsa' or model_type == 'test':
-                        if not (model_type == 'sample' and num_samples == 1):
-                            if model_type == 'sample':
-                                alpha = 1
-                            elif model_type == 'rsa':
-                                alpha = 0.0001
-                            else:
-                                alpha = 0
-                            if model_type != 'test':
-                                best_score_diff = -math.inf*torch.ones(batch_size)
-                                best_lang = torch.zeros((langs.shape[1],langs.shape[2],langs.shape[3]))
-                                best_lang_length = torch.zeros(lang_lengths.shape[1])
-                                for lang, lang_length in zip(langs, lang_lengths):
-                                    lis_scores = internal_listener(img, lang, lang_length)
-                                    score_diff = ((lis_scores[:,0].cpu()-np.delete(lis_scores.cpu(), y.cpu(), axis=1).mean(axis=1)))
-                                    for game in range(batch_size):
-                                        score_diff[game] = (score_diff[game]-alpha*lang_length[game]).cpu()
-                                        if score_diff[game]>best_score_diff[game]:
-                                            best_score_diff[game] = score_diff[game]
-                                            best_lang[game] = lang[game]
-                                            best_lang_length[game] = lang_length[game]
+                        #lang_out = lang_out.view(batch_size*lang_out.size(1), )
+                        #lang = lang.long().view(batch_size*lang.size(1), len(vocab['w2i'].keys()))
+                        #this_loss = loss(lang_out.cuda(), torch.max(lang, 1)[1].cuda())
 
-                                lang = best_lang
-                                lang_length = best_lang_length
-                            else:
-                                lang = langs.squeeze()
-                                lang_length = lang_lengths.squeeze()
-                        end = time.time()
-                        lis_scores = listener(img, lang, lang_length)
-                        
-                        # Evaluate loss and accuracy
-                        lis_pred = lis_scores.argmax(1)
-                        correct = (lis_pred == y)
-                        this_acc = correct.float().mean().item()
-                        this_loss = loss(lis_scores.cuda(), y.long())
-                        this_acc = correct.float().mean().item()
-                                
                         if split == 'train':
                             # SGD step
                             this_loss.backward()
                             optimizer.step()
-                        if split == 'test':
-                            meters, outputs = _collect_outputs(meters, outputs, vocab, img, y, lang, lang_length, lis_pred, lis_scores, this_loss, this_acc, batch_size, ci_listeners, language_model, (end-start), text=text)
-                        else:
+                        
+                        # same (time-wise argmax) accuracy as with one-hot targets:
+                        # the first position of each token id (0 if absent), from the ids
+                        first = torch.full((lang.shape[0], V), lang.shape[1], dtype=torch.long, device=lang.device)
+                        first.scatter_reduce_(1, lang, torch.arange(lang.shape[1], device=lang.device).expand_as(lang), 'amin')
+                        first[first == lang.shape[1]] = 0
+                        this_acc = (lang_out.argmax(1)==first).float().mean().item()
+
+                        meters['loss'].update(this_loss, batch_size)
+                        meters['acc'].update(this_acc, batch_size)
+                        # ...?
+                        """
+                        if split == "train":   
                             meters['loss'].update(this_loss, batch_size)
                             meters['acc'].update(this_acc, batch_size)
-                    else:
-                        if split == 'train' and model_type == 'amortized' and activation == 'multinomial': # Reinforce
-                            end = time.time()
-                            lis_scores = listener(img, lang, lang_length, average=False)
-                        elif split == 'train' and model_type == 'amortized' and activation != 'gumbel' and activation != None:
-                            end = time.time()
-                            lis_scores = listener(img, lang, lang_length, average=True)
                         else:
-                            lang_onehot = lang.argmax(2)
-                            # lang_onehot does not require grad
-                            if activation != 'gumbel' and activation != None:
-                                lang = F.one_hot(lang_onehot, num_classes = len(vocab['w2i'].keys())).cuda().float()
-                            lang_length = []
-                            for seq in lang_onehot: 
-                                lang_length.append(np.where(seq.cpu()==data.EOS_IDX)[0][0]+1)
-                            lang_length = torch.tensor(lang_length).cuda()
+                            meters['loss'].append(this_loss)
+                            meters['acc'].append(this_acc)
+                        """
+                    else:
+                        if model_type == 'sample' or model_type == 'rsa' or model_type == 'test':
+                            if not (model_type == 'sample' and num_samples == 1):
+                                if model_type == 'sample':
+                                    alpha = 1
+                                elif model_type == 'rsa':
+                                    alpha = 0.0001
+                                else:
+                                    alpha = 0
+                                if model_type != 'test':
+                                    best_score_diff = -math.inf*torch.ones(batch_size)
+                                    best_lang = torch.zeros((langs.shape[1],langs.shape[2],langs.shape[3]))
+                                    best_lang_length = torch.zeros(lang_lengths.shape[1])
+                                    for lang, lang_length in zip(langs, lang_lengths):
+                                        lis_scores = internal_listener(img, lang, lang_length)
+                                        score_diff = ((lis_scores[:,0].cpu()-np.delete(lis_scores.cpu(), y.cpu(), axis=1).mean(axis=1)))
+                                        for game in range(batch_size):
+                                            score_diff[game] = (score_diff[game]-alpha*lang_length[game]).cpu()
+                                            if score_diff[game]>best_score_diff[game]:
+                                                best_score_diff[game] = score_diff[game]
+                                                best_lang[game] = lang[game]
+                                                best_lang_length[game] = lang_length[game]
+
+                                    lang = best_lang
+                                    lang_length = best_lang_length
+                                else:
+                                    lang = langs.squeeze()
+                                    lang_length = lang_lengths.squeeze()
                             end = time.time()
                             lis_scores = listener(img, lang, lang_length)
-                            #import pdb; pdb.set_trace()
+                        
+                            # Evaluate loss and accuracy
+                            lis_pred = lis_scores.argmax(1)
+                            correct = (lis_pred == y)
+                            this_acc = correct.float().mean().item()
+                            this_loss = loss(lis_scores.cuda(), y.long())
+                            this_acc = correct.float().mean().item()
+                                
+                            if split == 'train':
+                                # SGD step
+                                this_loss.backward()
+                                optimizer.step()
+                            if split == 'test':
+                                meters, outputs = _collect_outputs(meters, outputs, vocab, img, y, lang, lang_length, lis_pred, lis_scores, this_loss, this_acc, batch_size, ci_listeners, language_model, (end-start), text=text)
+                            else:
+                                meters['loss'].update(this_loss, batch_size)
+                                meters['acc'].update(this_acc, batch_size)
+                        else:
+                            if split == 'train' and model_type == 'amortized' and activation == 'multinomial': # Reinforce
+                                end = time.time()
+                                lis_scores = listener(img, lang, lang_length, average=False)
+                            elif split == 'train' and model_type == 'amortized' and activation != 'gumbel' and activation != None:
+                                end = time.time()
+                                lis_scores = listener(img, lang, lang_length, average=True)
+                            else:
+                                lang_onehot = lang.argmax(2) if lang.dim() == 3 else lang
+                                # lang_onehot does not require grad
+                                if activation != 'gumbel' and activation != None:
+                                    lang = lang_onehot
+                                lang_length = []
+                                for seq in lang_onehot: 
+                                    lang_length.append(np.where(seq.cpu()==data.EOS_IDX)[0][0]+1)
+                                lang_length = torch.tensor(lang_length).cuda()
+                                end = time.time()
+                                lis_scores = listener(img, lang, lang_length)
+                                #import pdb; pdb.set_trace()
                             
-                        # Evaluate loss and accuracy
-                        if model_type == 'l0':
-                            this_loss = loss(lis_scores, y.long())
-                        elif model_type == 'amortized':
-                            if activation == 'multinomial':
-                                # Compute policy loss - sample from listener
-                                # DETERMINISTIC REWARD
-                                #  lis_choices = lis_scores.argmax(1)  # deterministically choose best
-                                # STOCHASTIC REWARD
-                                #lis_choices = torch.distributions.Categorical(probs=lis_scores).sample()
-                                lis_choices = torch.distributions.Categorical(logits=lis_scores).sample()
-                                returns = lis_choices == y
-                                # No reward for saying nothing
-                                not_zero = lang_length > 2
-                                returns = (returns & not_zero).float()
-                                # Length penalty - less returns
-                                # In the amortized model, we don't penalize
-                                # SOS, so the true length that we penalize
-                                # is lang_length - 1.
-                                LENGTH_PENALTY = 0.01
-                                returns = returns - LENGTH_PENALTY * (lang_length.to(returns.device).float() - 1)
-                                returns = torch.clamp(returns, 0.0, 1.0)
-                                # Slight negative reward for getting things wrong
-                                # (TODO: tweak this)
-                                #  returns = (1 * returns) + (-0.1 * (1 - returns))
-                                # FIXME: Should we normalize in the binary case?
-                                policy_loss = (-lang_prob * returns).mean()
-                                this_loss = policy_loss
-                            elif penalty == "bayes" or penalty == "map":
-                                # dont use marginal language model!
-                                marg_lang_prob = language_model.probability(lang, lang_length)
+                            # Evaluate loss and accuracy
+                            if model_type == 'l0':
+                                this_loss = loss(lis_scores, y.long())
+                            elif model_type == 'amortized':
+                                if activation == 'multinomial':
+                                    # Compute policy loss - sample from listener
+                                    # DETERMINISTIC REWARD
+                                    #  lis_choices = lis_scores.argmax(1)  # deterministically choose best
+                                    # STOCHASTIC REWARD
+                                    #lis_choices = torch.distributions.Categorical(probs=lis_scores).sample()
+                                    lis_choices = torch.distributions.Categorical(logits=lis_scores).sample()
+                                    returns = lis_choices == y
+                                    # No reward for saying nothing
+                                    not_zero = lang_length > 2
+                                    returns = (returns & not_zero).float()
+                                    # Length penalty - less returns
+                                    # In the amortized model, we don't penalize
+                                    # SOS, so the true length that we penalize
+                                    # is lang_length - 1.
+                                    LENGTH_PENALTY = 0.01
+                                    returns = returns - LENGTH_PENALTY * (lang_length.to(returns.device).float() - 1)
+                                    returns = torch.clamp(returns, 0.0, 1.0)
+                                    # Slight negative reward for getting things wrong
+                                    # (TODO: tweak this)
+                                    #  returns = (1 * returns) + (-0.1 * (1 - returns))
+                                    # FIXME: Should we normalize in the binary case?
+                                    policy_loss = (-lang_prob * returns).mean()
+                                    this_loss = policy_loss
+                                elif penalty == "bayes" or penalty == "map":
+                                    # dont use marginal language model!
+                                    marg_lang_prob = language_model.probability(lang, lang_length)
 
-                                # ideally you would loop over contexts,
-                                # but i think the model is pretty broken and that wont do anything
-                                s0_lang_prob = s0.probability(img, lang, lang_length, y)
-                                sc_lang_prob = sc.probability(img, lang, lang_length, y)
+                                    # ideally you would loop over contexts,
+                                    # but i think the model is pretty broken and that wont do anything
+                                    s0_lang_prob = s0.probability(img, lang, lang_length, y)
+                                    sc_lang_prob = sc.probability(img, lang, lang_length, y)
 
-                                #print((lang_prob - s0_lang_prob).max())
+                                    #print((lang_prob - s0_lang_prob).max())
 
-                                # average over batch
-                                Hq = lang_prob.sum(0).mean()
-                                #Hp = marg_lang_prob.sum(0).mean()
-                                #Hp = s0_lang_prob.sum(0).mean()
-                                Hp = sc_lang_prob.sum(0).mean()
+                                    # average over batch
+                                    Hq = lang_prob.sum(0).mean()
+                                    #Hp = marg_lang_prob.sum(0).mean()
+                                    #Hp = s0_lang_prob.sum(0).mean()
+                                    Hp = sc_lang_prob.sum(0).mean()
 
-                                # ELBO
-                                nll = loss(lis_scores, y.long())
-                                kl = Hq - Hp
-                                #this_loss = nll + kl
-                                this_loss = nll - Hp if penalty == "map" else nll + kl
-                                #import pdb; pdb.set_trace()
+                                    # ELBO
+                                    nll = loss(lis_scores, y.long())
+                                    kl = Hq - Hp
+                                    #this_loss = nll + kl
+                                    this_loss = nll - Hp if penalty == "map" else nll + kl
+                                    #import pdb; pdb.set_trace()
 
+                                else:
+                                    # no penalty or length penalty
+                                    this_loss = loss(lis_scores,y.long())
+                                this_loss = this_loss + eos_loss * float(lmbd)
                             else:
-                                # no penalty or length penalty
-                                this_loss = loss(lis_scores,y.long())
-                            this_loss = this_loss + eos_loss * float(lmbd)
-                        else:
-                            this_loss = loss(lis_scores, y.long())
+                                this_loss = loss(lis_scores, y.long())
                             
-                        lis_pred = lis_scores.argmax(1)
-                        correct = (lis_pred == y)
-                        this_acc = correct.float().mean().item()
+                            lis_pred = lis_scores.argmax(1)
+                            correct = (lis_pred == y)
+                            this_acc = correct.float().mean().item()
                         
-                        if split == 'train':
-                            # SGD step
-                            this_loss.backward()
-                            meh = speaker.embedding.weight.clone().detach()
-                            optimizer.step()
-                            #print((speaker.embedding.weight - meh).abs().max())
-                            #print((speaker.embedding.weight - meh).mean())
-                            #print((speaker.embedding.weight - meh).abs().median())
-                            #import pdb; pdb.set_trace()
+                            if split == 'train':
+                                # SGD step
+                                this_loss.backward()
+                                meh = speaker.embedding.weight.clone().detach()
+                                optimizer.step()
+                                #print((speaker.embedding.weight - meh).abs().max())
+                                #print((speaker.embedding.weight - meh).mean())
+                                #print((speaker.embedding.weight - meh).abs().median())
+                                #import pdb; pdb.set_trace()
+
+                            if split == 'test':
+                                meters, outputs = _collect_outputs(meters, outputs, vocab, img, y, lang, lang_length, lis_pred, lis_scores, this_loss, this_acc, batch_size, ci_listeners, language_model, (end-start), text=text)
+                            else:
+                                meters['loss'].update(this_loss-eos_loss*float(lmbd), batch_size)
+                                meters['lm loss'].update(eos_loss*float(lmbd), batch_size)
+                                meters['acc'].update(this_acc, batch_size)
+                                meters['length'].update(lang_length.float().mean(), batch_size)
+    finally:
+        # Don't leave shared (registry) models in train mode for the next
+        # caller, even if a batch raised
+        registry.reset_modes()
 
-                        if split == 'test':
-                            meters, outputs = _collect_outputs(meters, outputs, vocab, img, y, lang, lang_length, lis_pred, lis_scores, this_loss, this_acc, batch_size, ci_listeners, language_model, (end-start), text=text)
-                        else:
-                            meters['loss'].update(this_loss-eos_loss*float(lmbd), batch_size)
-                            meters['lm loss'].update(eos_loss*float(lmbd), batch_size)
-                            meters['acc'].update(this_acc, batch_size)
-                            meters['length'].update(lang_length.float().mean(), batch_size)
-        
     if split == 'test':
         metrics = compute_average_metrics(meters)
         """
@@ -490,7 +514,9 @@ def run(data_file, split, model_type, speaker, listener, optimizer, loss, vocab,
         metrics = compute_average_metrics(meters)
     if model_type == 'amortized':
         seq = []
-        for word_index in lang.argmax(2)[0,:].cpu().numpy():
+        if lang.dim() == 3:
+            lang = lang.argmax(2)
+        for word_index in lang[0,:].cpu().numpy():
             try:
                 seq.append(vocab['i2w'][word_index])
             except:
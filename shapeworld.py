@@ -6,12 +6,14 @@ from shapely.geometry import Point, box
 from shapely import affinity
 import numpy as np
 from numpy import random
-from PIL import Image
+from PIL import Image, ImageColor
 import aggdraw
 from enum import Enum
 from tqdm import tqdm
 import os
+import threading
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple
 
 DIM = 64
@@ -28,9 +30,33 @@ COLORS = ['red', 'blue', 'green', 'yellow', 'white', 'gray']
 VOCAB = ['gray', 'shape', 'blue', 'square', 'circle', 'green', 'red', 'rectangle', 'yellow', 'ellipse', 'white']
 BRUSHES = {c: aggdraw.Brush(c) for c in COLORS}
 PENS = {c: aggdraw.Pen(c) for c in COLORS}
+COLOR_RGB = np.array([ImageColor.getrgb(c) for c in COLORS], dtype=np.float32)
+
+# Parametric scenes: one row of SCENE_FIELDS per shape, up to MAX_SHAPES per
+# image, shape index -1 for an empty slot. See Shape.params/render_scenes.
+SCENE_FIELDS = ['shape', 'color', 'x', 'y', 'dx', 'dy', 'angle']
+MAX_SHAPES = 2
+# (grow, shift) in pixels per shape, fit so render_scenes matches aggdraw:
+# the 1px pen, integer vertex coords and, for ellipses, a polygon drawn
+# through the sorted boundary points all make drawn shapes larger
+RENDER_PAD = np.array([
+    [0.25, 0.],  # circle
+    [0.5, 0.],  # square
+    [0.5, 0.],  # rectangle
+    [1.25, -0.5],  # ellipse
+], dtype=np.float32)
+# Image backends of generate: per-image aggdraw drawing, sampling scenes
+# only and rasterizing them with render_scenes, RENDER_CHUNK games per task,
+# or scenes only with no images at all (for parametric shards)
+BACKENDS = ['aggdraw', 'numpy', 'scenes']
+RENDER_CHUNK = 128
+# Side of the square rasterized around each shape, covers the largest one
+RENDER_WINDOW = 2 * (SIZE_MAX + 4)
 
 
 MAX_PLACEMENT_ATTEMPTS = 5
+# Positions proposed (and collision-tested together) per placement attempt
+PLACEMENT_CANDIDATES = 16
 
 
 class ShapeSpec(Enum):
@@ -106,14 +132,29 @@ class Shape:
                     self.y = random.randint(X_MIN_34, X_MAX)
         self.init_shape()
 
+    def __getattr__(self, name):
+        # The shapely geometry and drawing coords are only built once used
+        # (e.g. not at all for the numpy backend), from the sampled params
+        if name in ('shape', 'coords'):
+            self.build()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
     def draw(self, image):
         image.draw.polygon(self.coords, PENS[self.color])
 
     def intersects(self, oth):
         return self.shape.intersects(oth.shape)
 
+    def params(self):
+        """Scene parameters of this shape, in SCENE_FIELDS order."""
+        return (SHAPES.index(self.name), COLORS.index(self.color), self.x,
+                self.y, self.dx, self.dy, self.angle)
+
 
 class Ellipse(Shape):
+    name = 'ellipse'
+
     def init_shape(self, min_skew=1.5):
         self.dx = rand_size()
         # Dy must be at least 1.6x dx, to remove ambiguity with circle
@@ -127,14 +168,16 @@ class Ellipse(Shape):
         if random.random() < 0.5:
             # Switch dx, dy
             self.dx, self.dy = self.dy, self.dx
+        self.angle = random.randint(360)
 
+    def build(self):
         shape = Point(self.x, self.y).buffer(1)
         shape = affinity.scale(shape, self.dx, self.dy)
-        shape = affinity.rotate(shape, random.randint(360))
+        shape = affinity.rotate(shape, self.angle)
         self.shape = shape
 
         #  self.coords = [int(x) for x in self.shape.bounds]
-        self.coords = np.round(np.array(self.shape.boundary).astype(np.int))
+        self.coords = np.round(np.array(self.shape.boundary.coords).astype(int))
         #  print(len(np.array(self.shape.convex_hull)))
         #  print(len(np.array(self.shape.convex_hull.boundary)))
         #  print(len(np.array(self.shape.exterior)))
@@ -142,8 +185,14 @@ class Ellipse(Shape):
 
 
 class Circle(Ellipse):
+    name = 'circle'
+
     def init_shape(self):
         self.r = rand_size()
+        self.dx = self.dy = self.r
+        self.angle = 0
+
+    def build(self):
         self.shape = Point(self.x, self.y).buffer(self.r)
         self.coords = [int(x) for x in self.shape.bounds]
 
@@ -152,6 +201,8 @@ class Circle(Ellipse):
 
 
 class Rectangle(Shape):
+    name = 'rectangle'
+
     def init_shape(self, min_skew=1.5):
         self.dx = rand_size_2()
         bigger = int(self.dx * min_skew)
@@ -163,33 +214,31 @@ class Rectangle(Shape):
         if random.random() < 0.5:
             # Switch dx, dy
             self.dx, self.dy = self.dy, self.dx
+        self.angle = random.randint(90)
 
+    def build(self):
         shape = box(self.x, self.y, self.x + self.dx, self.y + self.dy)
         # Rotation
-        shape = affinity.rotate(shape, random.randint(90))
+        shape = affinity.rotate(shape, self.angle)
         self.shape = shape
 
         # Get coords
         self.coords = np.round(
             np.array(self.shape.exterior.coords)[:-1].flatten()).astype(
-                np.int).tolist()
+                int).tolist()
 
     def draw(self, image):
         image.draw.polygon(self.coords, BRUSHES[self.color], PENS[self.color])
 
 
 class Square(Rectangle):
+    name = 'square'
+
     def init_shape(self):
         self.size = rand_size_2()
-        shape = box(self.x, self.y, self.x + self.size, self.y + self.size)
+        self.dx = self.dy = self.size
         # Rotation
-        shape = affinity.rotate(shape, random.randint(90))
-        self.shape = shape
-
-        # Get coords
-        self.coords = np.round(
-            np.array(self.shape.exterior.coords)[:-1].flatten()).astype(
-                np.int).tolist()
+        self.angle = random.randint(90)
 
 
 SHAPE_IMPLS = {
@@ -227,6 +276,240 @@ class I:
         self.image.save(path, filetype)
 
 
+def _geometry(params):
+    """
+    Drawn center (cx, cy), half axes (a, b), rotation and box mask of one
+    shape per row of ``params`` (float array in SCENE_FIELDS order).
+    """
+    shape, _, x, y, dx, dy, angle = params.T
+    is_box = (shape == SHAPES.index('square')) | (shape == SHAPES.index('rectangle'))
+    grow, shift = RENDER_PAD[np.maximum(shape, 0).astype(np.int64)].T
+    # Boxes are anchored at their corner, ellipses at their center
+    cx = np.where(is_box, x + dx / 2, x) + shift
+    cy = np.where(is_box, y + dy / 2, y) + shift
+    a = np.where(is_box, dx / 2, dx) + grow
+    b = np.where(is_box, dy / 2, dy) + grow
+    return cx, cy, a, b, np.deg2rad(angle), is_box
+
+
+def shape_bounds(params):
+    """
+    Axis-aligned bounding boxes (xmin, ymin, xmax, ymax) of the drawn shapes,
+    one row per row of ``params``.
+    """
+    cx, cy, a, b, theta, is_box = _geometry(np.asarray(params, dtype=np.float32))
+    cos, sin = np.abs(np.cos(theta)), np.abs(np.sin(theta))
+    hw = np.where(is_box, a * cos + b * sin, np.hypot(a * cos, b * sin))
+    hh = np.where(is_box, a * sin + b * cos, np.hypot(a * sin, b * cos))
+    return np.stack([cx - hw, cy - hh, cx + hw, cy + hh], axis=-1)
+
+
+def _coverage(params, ss):
+    """
+    Fraction of each pixel covered by one shape per row of ``params``
+    (float array in SCENE_FIELDS order), from ss x ss samples per pixel.
+    Only a RENDER_WINDOW-pixel square around each shape is rasterized.
+
+    Returns
+    -------
+    cov : ``np.Array``
+        (n, RENDER_WINDOW, RENDER_WINDOW) coverage
+    y0, x0 : ``np.Array``
+        Image coordinates of the top left pixel of each window
+    """
+    cx, cy, a, b, theta, is_box = _geometry(params)
+    cos = np.cos(theta)[:, None, None]
+    sin = np.sin(theta)[:, None, None]
+
+    x0 = np.floor(cx).astype(np.int64) - RENDER_WINDOW // 2
+    y0 = np.floor(cy).astype(np.int64) - RENDER_WINDOW // 2
+    samples = ((np.arange(RENDER_WINDOW * ss) + 0.5) / ss).astype(np.float32)
+    u = samples[None, None, :] + (x0 - cx)[:, None, None]
+    v = samples[None, :, None] + (y0 - cy)[:, None, None]
+    # Undo the (shapely) rotation about the shape center
+    qx = (cos * u + sin * v) / a[:, None, None]
+    qy = (cos * v - sin * u) / b[:, None, None]
+    inside = np.where(is_box[:, None, None],
+                      (np.abs(qx) <= 1) & (np.abs(qy) <= 1),
+                      qx ** 2 + qy ** 2 <= 1)
+    cov = inside.reshape(-1, RENDER_WINDOW, ss, RENDER_WINDOW, ss).mean(axis=(2, 4))
+    return cov.astype(np.float32), y0, x0
+
+
+def _grow(arr, n):
+    """``arr`` if it has at least ``n`` rows, else a copy with room to spare."""
+    if n <= len(arr):
+        return arr
+    grown = np.zeros((max(n, 2 * len(arr)), ) + arr.shape[1:], dtype=arr.dtype)
+    grown[:len(arr)] = arr
+    return grown
+
+
+class CoverageCache:
+    """
+    Pixels covered by shapes, rasterized once per process and supersampling
+    factor ``ss``. With integer scene params, (shape, dx, dy, angle) fix a
+    shape's coverage up to a whole-pixel translation by (x, y), so that is
+    the cache key. Each covered pixel is stored as one int32: its offset
+    dy * DIM + dx from the shape's window, shifted left 8 bits, plus the
+    number of its ss x ss samples inside.
+
+    Lookups read an immutable (entries, meta, pixels) snapshot and need no
+    lock; additions append past the end of the arrays, which no published
+    entry refers to, and publish a new snapshot.
+    """
+
+    def __init__(self, ss):
+        assert ss * ss < 256, ss
+        self.ss = ss
+        self.lock = threading.Lock()
+        self.n_pixels = 0
+        # key -> entry; per entry (start, length, y0, x0) and the bounds
+        # (ymin, ymax, xmin, xmax) of its pixels; packed pixels
+        self.snapshot = ({}, np.zeros((0, 8), dtype=np.int64), np.zeros(0, dtype=np.int32))
+
+    def lookup(self, params):
+        """
+        Pixels covered by one shape per row of integer ``params``, clipped to
+        the image.
+
+        Returns
+        -------
+        row, pix, level : ``np.Array``
+            Per covered pixel: row of ``params``, index y * DIM + x in the
+            image and number of its ss x ss samples covered
+        """
+        p = params.astype(np.int64)
+        keys = ((p[:, 0] * 1024 + p[:, 4]) * 1024 + p[:, 5]) * 1024 + p[:, 6] % 360
+        keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        keys = keys.tolist()
+        if any(k not in self.snapshot[0] for k in keys):
+            with self.lock:
+                self._add(params, keys, first)
+        entries, meta, pixels = self.snapshot
+        entry = np.array([entries[k] for k in keys], dtype=np.int64)[inverse.ravel()]
+        start, n_px, y0, x0, ymin, ymax, xmin, xmax = meta[entry].T
+        y0, x0 = y0 + p[:, 3], x0 + p[:, 2]
+        # Concatenate the cached pixels of every row
+        row = np.repeat(np.arange(len(p)), n_px)
+        ends = np.cumsum(n_px)
+        packed = pixels[np.arange(len(row)) + np.repeat(start - (ends - n_px), n_px)]
+        level = packed & 255
+        offset = packed >> 8
+        pix = (y0 * DIM + x0)[row] + offset
+        # Clip the few shapes reaching past the border
+        spill = (y0 + ymin < 0) | (y0 + ymax >= DIM) | (x0 + xmin < 0) | (x0 + xmax >= DIM)
+        if spill.any():
+            check = np.nonzero(spill[row])[0]
+            y = offset[check] // DIM + y0[row[check]]
+            x = offset[check] % DIM + x0[row[check]]
+            inside = np.ones(len(row), dtype=bool)
+            inside[check] = (y >= 0) & (y < DIM) & (x >= 0) & (x < DIM)
+            row, pix, level = row[inside], pix[inside], level[inside]
+        return row, pix, level
+
+    def _add(self, params, keys, first):
+        entries, meta, pixels = self.snapshot
+        missing = [j for j, k in enumerate(keys) if k not in entries]
+        if not missing:
+            return
+        new = params[first[missing]].astype(np.float32)
+        new[:, 2:4] = 0
+        cov, y0, x0 = _coverage(new, self.ss)
+        w, dy, dx = np.nonzero(cov)
+        level = np.round(cov[w, dy, dx] * self.ss * self.ss).astype(np.int32)
+        length = np.bincount(w, minlength=len(missing))
+        # Empty windows get bounds that never spill
+        bounds = np.zeros((len(missing), 4), dtype=np.int64)
+        bounds[:, [0, 2]] = RENDER_WINDOW
+        np.minimum.at(bounds[:, 0], w, dy)
+        np.maximum.at(bounds[:, 1], w, dy)
+        np.minimum.at(bounds[:, 2], w, dx)
+        np.maximum.at(bounds[:, 3], w, dx)
+        n_entries, n_pixels = len(entries), self.n_pixels
+        meta = _grow(meta, n_entries + len(missing))
+        pixels = _grow(pixels, n_pixels + len(w))
+        meta[n_entries:n_entries + len(missing)] = np.concatenate([np.stack(
+            [n_pixels + np.cumsum(length) - length, length, y0, x0], 1), bounds], 1)
+        pixels[n_pixels:n_pixels + len(w)] = ((dy * DIM + dx) << 8) | level
+        entries = dict(entries)
+        entries.update((keys[j], n_entries + i) for i, j in enumerate(missing))
+        self.n_pixels = n_pixels + len(w)
+        self.snapshot = (entries, meta, pixels)
+
+
+# CoverageCache per supersampling factor
+_COVERAGE = {}
+
+
+def coverage_cache(ss):
+    """The process-wide ``CoverageCache`` for supersampling factor ``ss``."""
+    cache = _COVERAGE.get(ss)
+    if cache is None:
+        cache = _COVERAGE.setdefault(ss, CoverageCache(ss))
+    return cache
+
+
+def render_scenes(scenes, antialias=2, chunk=1024):
+    """
+    Rasterize parametric scenes with NumPy, a whole batch at a time. Each
+    distinct (shape, size, rotation) is rasterized once per process and
+    cached as its covered pixels, which are then copied into the images
+    (blended only where shapes overlap). Close to, not identical with,
+    aggdraw's drawing: see ``compare_backends``.
+
+    Parameters
+    ----------
+    scenes : ``np.Array``
+        Integer array of shape (..., MAX_SHAPES, len(SCENE_FIELDS)), as
+        collected by ``generate``. Shapes are drawn in order.
+    antialias : ``int``, optional (default: 2)
+        Supersampling factor per axis; 1 disables antialiasing
+    chunk : ``int``, optional (default: 1024)
+        Images composited at once, bounds temporary memory
+
+    Returns
+    -------
+    imgs : ``np.Array``
+        uint8 array of shape (..., 64, 64, 3)
+    """
+    scenes = np.asarray(scenes)
+    batch_shape = scenes.shape[:-2]
+    scenes = scenes.reshape((-1, ) + scenes.shape[-2:])
+    ss = max(int(antialias), 1)
+    cache = coverage_cache(ss)
+    n_levels = ss * ss + 1
+    alpha = (np.arange(n_levels) / (ss * ss)).astype(np.float32)
+    # Every color at every coverage over black, one 3-byte item per pixel
+    lut = np.round(COLOR_RGB[:, None, :] * alpha[None, :, None]).astype(np.uint8)
+    lut = lut.reshape(-1, 3).view('V3').ravel()
+    imgs = np.zeros((len(scenes), DIM, DIM, 3), dtype=np.uint8)
+    for start in range(0, len(scenes), chunk):
+        sc = scenes[start:start + chunk]
+        pixels = imgs[start:start + chunk].reshape(-1, 3)
+        items = pixels.view('V3').ravel()
+        # Pixels drawn so far
+        drawn = np.zeros(len(pixels), dtype=bool)
+        for k in range(sc.shape[1]):
+            n_idx = np.nonzero(sc[:, k, 0] >= 0)[0]
+            if len(n_idx) == 0:
+                continue
+            row, pix, level = cache.lookup(sc[n_idx, k])
+            pix += (n_idx * DIM * DIM)[row]
+            color = sc[n_idx, k, 1].astype(np.int64)[row]
+            # Blend over whatever earlier shapes drew, if anything
+            over = np.nonzero(drawn[pix])[0] if k else []
+            if len(over):
+                cov = alpha[level[over], None]
+                below = pixels[pix[over]]
+            items[pix] = lut[color * n_levels + level]
+            if len(over):
+                pixels[pix[over]] = np.round(below * (1 - cov) + cov * COLOR_RGB[color[over]])
+            if k + 1 < sc.shape[1]:
+                drawn[pix] = True
+    return imgs.reshape(batch_shape + (DIM, DIM, 3))
+
+
 def random_shape():
     return random.choice(SHAPES)
 
@@ -301,32 +584,108 @@ def add_shape_from_spec(spec,
     return shape
 
 
-def add_shape_rel(spec, oth_shape, relation, relation_dir):
+def _rel_ranges(oth_shape, relation, relation_dir):
     """
-    Add shape, obeying the relation/relation_dir w.r.t. oth shape
+    ((x_low, x_high), (y_low, y_high)) positions (high exclusive) obeying the
+    relation/relation_dir w.r.t. oth shape
     """
-    color, shape_ = spec
-    if shape_ is None:
-        shape_ = random_shape()
+    xs = ys = (X_MIN, X_MAX)
     if relation == 0:
-        new_y = rand_pos()
         if relation_dir == 0:
             # Shape must be LEFT of oth shape
-            new_x = random.randint(X_MIN, oth_shape.x - BUFFER)
+            xs = (X_MIN, oth_shape.x - BUFFER)
         else:
             # Shape RIGHT of oth shape
-            new_x = random.randint(oth_shape.x + BUFFER, X_MAX)
+            xs = (oth_shape.x + BUFFER, X_MAX)
     else:
-        new_x = rand_pos()
         if relation_dir == 0:
             # BELOW (remember y coords reversed)
-            new_y = random.randint(oth_shape.y + BUFFER, X_MAX)
+            ys = (oth_shape.y + BUFFER, X_MAX)
         else:
             # ABOVE
-            new_y = random.randint(X_MIN, oth_shape.y - BUFFER)
+            ys = (X_MIN, oth_shape.y - BUFFER)
+    return xs, ys
+
+
+def add_shape_rel(spec, oth_shape, relation, relation_dir):
+    """
+    Add shape, obeying the relation/relation_dir w.r.t. oth shape
+    """
+    color, shape_ = spec
+    if shape_ is None:
+        shape_ = random_shape()
+    xs, ys = _rel_ranges(oth_shape, relation, relation_dir)
+    if relation == 0:
+        new_y = random.randint(*ys)
+        new_x = random.randint(*xs)
+    else:
+        new_x = random.randint(*xs)
+        new_y = random.randint(*ys)
     return SHAPE_IMPLS[shape_](x=new_x, y=new_y, color=color)
 
 
+def first_free(params, shapes, ss=2):
+    """
+    Index of the first candidate shape (row of ``params``) that overlaps none
+    of ``shapes``, or None. Bounding boxes rule out most pairs; candidates
+    before the first clear one are compared as raster masks of the drawn
+    pixels, all at once.
+    """
+    params = np.asarray(params, dtype=np.float32)
+    if not shapes:
+        return 0
+    placed = np.array([s.params() for s in shapes], dtype=np.float32)
+    boxes = shape_bounds(np.concatenate([placed, params]))
+    placed_box, cand_box = boxes[None, :len(placed)], boxes[len(placed):, None]
+    near = ((cand_box[..., :2] < placed_box[..., 2:]) &
+            (placed_box[..., :2] < cand_box[..., 2:])).all(-1).any(-1)
+    clear = np.nonzero(~near)[0]
+    first = clear[0] if len(clear) else len(params)
+    if first == 0:
+        return 0
+    # Pixels drawn by the placed shapes, on a canvas padded so that
+    # coverage windows never fall off it
+    pad = RENDER_WINDOW
+    win = np.arange(RENDER_WINDOW)
+    canvas = np.zeros((DIM + 2 * pad, DIM + 2 * pad), dtype=bool)
+    cov, y0, x0 = _coverage(placed, ss)
+    for c, y, x in zip(cov, y0 + pad, x0 + pad):
+        canvas[y:y + RENDER_WINDOW, x:x + RENDER_WINDOW] |= c > 0
+    cov, y0, x0 = _coverage(params[:first], ss)
+    rows = (y0 + pad)[:, None, None] + win[None, :, None]
+    cols = (x0 + pad)[:, None, None] + win[None, None, :]
+    free = np.nonzero(~((cov > 0) & canvas[rows, cols]).any(axis=(1, 2)))[0]
+    if len(free):
+        return free[0]
+    return first if first < len(params) else None
+
+
+def place_shape_rel(spec, oth_shape, relation, relation_dir, shapes=None,
+                    n_candidates=PLACEMENT_CANDIDATES):
+    """
+    Add shape obeying the relation/relation_dir w.r.t. oth shape and not
+    overlapping any of ``shapes`` (default: [oth_shape]). Each attempt samples
+    the shape once and proposes ``n_candidates`` positions for it, tested
+    together with ``first_free``.
+    """
+    if shapes is None:
+        shapes = [oth_shape]
+    xs, ys = _rel_ranges(oth_shape, relation, relation_dir)
+    for _ in range(MAX_PLACEMENT_ATTEMPTS):
+        shape = add_shape_rel(spec, oth_shape, relation, relation_dir)
+        params = np.tile(np.array(shape.params(), dtype=np.float32), (n_candidates, 1))
+        # The first candidate is where add_shape_rel put the shape
+        params[1:, 2] = random.randint(*xs, size=n_candidates - 1)
+        params[1:, 3] = random.randint(*ys, size=n_candidates - 1)
+        free = first_free(params, shapes)
+        if free is not None:
+            # Geometry is only built on first use, so moving it is free
+            shape.x, shape.y = (int(v) for v in params[free, 2:4])
+            return shape
+    raise RuntimeError("Could not place {} {} of shape at {}".format(
+        spec, (relation, relation_dir), (oth_shape.x, oth_shape.y)))
+
+
 def new_color(existing_color):
     new_c = existing_color
     while new_c == existing_color:
@@ -440,11 +799,12 @@ def generate_spatial(mp_args):
     """
     Generate a single image
     """
-    random.seed()
-    n_images, correct, i, data_type, context = mp_args
+    n_images, correct, i, data_type, context, draw, seed, generalization = mp_args
+    random.seed(seed)
     # Get shapes and relations
     imgs = np.zeros((n_images, 64, 64, 3), dtype=np.uint8)
     labels = np.zeros((n_images, ), dtype=np.uint8)
+    scenes = np.full((n_images, MAX_SHAPES, len(SCENE_FIELDS)), -1, dtype=np.int16)
     config = random_config_spatial()
     # Minimum of 2 correct worlds/2 distractors
     if data_type == 'concept':
@@ -467,63 +827,117 @@ def generate_spatial(mp_args):
         new_config = config if label else invalidate_spatial(config)
         (ss1, ss2), extra_shape_specs, relation, relation_dir = new_config
         s2 = add_shape_from_spec(ss2, relation, relation_dir)
-
-        attempts = 0
-        while attempts < MAX_PLACEMENT_ATTEMPTS:
-            # TODO: Support extra shapes
-            s1 = add_shape_rel(ss1, s2, relation, relation_dir)
-            if not s2.intersects(s1):
-                break
-        else:
-            # Failed
-            raise RuntimeError
+        # TODO: Support extra shapes (pass them all as shapes)
+        s1 = place_shape_rel(ss1, s2, relation, relation_dir)
 
         # Create image and draw shapes
-        img = I()
-        img.draw_shapes([s1, s2])
-        imgs[w_idx] = img.array()
+        if draw:
+            img = I()
+            img.draw_shapes([s1, s2])
+            imgs[w_idx] = img.array()
         labels[w_idx] = label
-    return imgs, labels, config, i
-
-
-def invalidate_single(config):
-    color, shape_ = config
-    if shape_ is not None and color is not None:
-        # Sample random part to invalidate
-        # Here, we can invalidate shape, or invalidate color, OR invalidate both
-        part_to_invalidate = random.randint(3)
-        if part_to_invalidate == 0:
-            return (new_color(color), shape_)
-        elif part_to_invalidate == 1:
-            return (color, new_shape(shape_))
-        elif part_to_invalidate == 2:
-            return (new_color(color), new_shape(shape_))
-        else:
-            raise RuntimeError
-    elif shape_ is not None:
-        assert color is None
-        return (None, new_shape(shape_))
-    elif color is not None:
-        assert shape_ is None
-        return (new_color(color), None)
-    else:
-        raise RuntimeError
+        scenes[w_idx, :2] = [s1.params(), s2.params()]
+    return imgs, labels, config, i, scenes
+
+
+# Every (color, shape) a single-shape image can show
+PAIRS = [(c, s) for c in COLORS for s in SHAPES]
+# Generalization splits of generate_single: the (color, shape) pairs held out
+# of the train split; in the test split the target is one of them
+GENERALIZATION = {
+    'new_color': [('red', s) for s in SHAPES],
+    'new_shape': [(c, 'square') for c in COLORS],
+    'new_combo': [('red', 'circle'), ('blue', 'square'), ('green', 'rectangle'),
+                  ('yellow', 'ellipse'), ('white', 'circle'), ('gray', 'square')],
+}
+GENERALIZATION_SPLITS = ['train', 'test']
+# How a distractor (color, shape) differs from the target's
+DISTRACTORS = {
+    'color': lambda t, p: p[0] != t[0] and p[1] == t[1],  # only in color
+    'shape': lambda t, p: p[0] == t[0] and p[1] != t[1],  # only in shape
+    'both': lambda t, p: p[0] != t[0] and p[1] != t[1],
+    'any_color': lambda t, p: p[0] != t[0],  # in color, any shape
+    'any_shape': lambda t, p: p[1] != t[1],  # in shape, any color
+}
+# Distractors per context mode: in context the target shares its shape with
+# the distractors ('shape'), its color ('color'), one of each ('both', see
+# distractor_relation) or nothing ('none')
+CONTEXTS = {
+    'shape': 'color',
+    'color': 'shape',
+    'none': 'both',
+}
+_CANDIDATES = {}
+
+
+def candidates(target=None, relation=None, generalization=None, role='target'):
+    """
+    The (color, shape) pairs an image of ``role`` may show, enumerated once
+    per argument combination.
+    Parameters
+    ----------
+    target : ``tuple``, optional (default: None)
+        Target (color, shape); required for distractors
+    relation : ``str``, optional (default: None)
+        ``DISTRACTORS`` key, how a distractor differs from ``target``
+    generalization : ``tuple``, optional (default: None)
+        (``GENERALIZATION`` key, ``'train'`` or ``'test'``)
+    role : ``str``, optional (default: 'target')
+        ``'target'`` or ``'distractor'``
+    """
+    key = (target, relation, generalization, role)
+    if key not in _CANDIDATES:
+        pairs = PAIRS
+        if role == 'distractor':
+            pairs = [p for p in pairs if DISTRACTORS[relation](target, p)]
+        if generalization is not None:
+            kind, split = generalization
+            held_out = GENERALIZATION[kind]
+            if split == 'train':
+                pairs = [p for p in pairs if p not in held_out]
+            elif role == 'target':
+                pairs = [p for p in pairs if p in held_out]
+        if not pairs:
+            raise ValueError("No {} for target {}, relation {}, generalization {}".format(
+                role, target, relation, generalization))
+        _CANDIDATES[key] = pairs
+    return _CANDIDATES[key]
+
+
+def sample_pair(*args, **kwargs):
+    pairs = candidates(*args, **kwargs)
+    return pairs[random.randint(len(pairs))]
+
+
+def distractor_relation(spec, context, w_idx):
+    """
+    ``DISTRACTORS`` key for image ``w_idx``. Without a context, a target
+    described by shape (color) only gets distractors of another shape (color);
+    one described by both differs in color, shape or both.
+    """
+    if context == 'both' and w_idx in (1, 2):
+        return 'color' if w_idx == 1 else 'shape'
+    if context in CONTEXTS:
+        return CONTEXTS[context]
+    if spec == ShapeSpec.SHAPE:
+        return 'any_shape'
+    if spec == ShapeSpec.COLOR:
+        return 'any_color'
+    return ['color', 'shape', 'both'][random.randint(3)]
 
 
 def generate_single(mp_args):
-    random.seed()
-    n_images, correct, i, data_type, context = mp_args
+    n_images, correct, i, data_type, context, draw, seed, generalization = mp_args
+    random.seed(seed)
     imgs = np.zeros((n_images, 64, 64, 3), dtype=np.uint8)
     labels = np.zeros((n_images, ), dtype=np.uint8)
-    config = random_config_single()
-    if context != None:
-        is_none = True
-        while is_none:
-            target_color, target_shape = config
-            if target_color is None or target_shape is None:
-                config = random_config_single()
-            else:
-                is_none = False
+    scenes = np.full((n_images, MAX_SHAPES, len(SCENE_FIELDS)), -1, dtype=np.int16)
+    if context not in (None, 'both', *CONTEXTS):
+        raise NotImplementedError("context = {}".format(context))
+    # What the target's description would specify; the language is derived
+    # from the sampled images below either way
+    spec = ShapeSpec.BOTH if context is not None else ShapeSpec(random.randint(3))
+    target = sample_pair(generalization=generalization)
     if data_type == 'concept':
         n_target = 2
         n_distract = 2
@@ -542,117 +956,23 @@ def generate_single(mp_args):
             n_distract -= 1
         else:
             label = (random.random() < correct)
-        new_config = config if label else invalidate_single(config)
-
-        color_, shape_ = new_config
-        if shape_ is None:
-            shape_ = random_shape()
-            
-        if context != None:
-            target_color, target_shape = config
-            if label == 1:
-                shape_ = target_shape
-                color_ = target_color
-            if label == 0:
-                if context == 'shape':
-                    shape_ = target_shape
-                    same_color = True
-                    while same_color:
-                        color_ = random_color()
-                        if color_ != target_color:
-                            same_color = False
-                if context == 'color':
-                    color_ = target_color
-                    same_shape = True
-                    while same_shape:
-                        shape_ = random_shape()
-                        if shape_ != target_shape:
-                            same_shape = False
-                if context == 'both':
-                    if w_idx == 1:
-                        shape_ = target_shape
-                        same_color = True
-                        while same_color:
-                            color_ = random_color()
-                            if color_ != target_color:
-                                same_color = False
-                    elif w_idx == 2:
-                        color_ = target_color
-                        same_shape = True
-                        while same_shape:
-                            shape_ = random_shape()
-                            if shape_ != target_shape:
-                                same_shape = False
-                if context == 'none':
-                    same_color = True
-                    while same_color:
-                        color_ = random_color()
-                        if color_ != target_color:
-                            same_color = False
-                    same_shape = True
-                    while same_shape:
-                        shape_ = random_shape()
-                        if shape_ != target_shape:
-                            same_shape = False
+        if label:
+            color_, shape_ = target
         else:
-            # shape generalization - train
-            """
-            if shape_ == 'square':
-                square = True
-            else:
-                square = False
-            while square:
-                shape_ = random_shape()
-                if shape_ != 'square':
-                    square = False"""
-            # shape generalization - test
-            """
-            if label == 1:
-                shape_ = 'square'"""
-            
-            # color generalization - train
-            """
-            if color_ == 'red':
-                red = True
-            else:
-                red = False
-            while red:
-                color_ = random_color()
-                if color_ != 'red':
-                    red = False"""
-            # color generalization - test
-            """
-            if label == 1:
-                color_ = 'red'"""
-
-            # combo generalization - train
-            """
-            if (color_ == 'red' and shape_ == 'circle') or (color_ == 'blue' and shape_ == 'square') or (color_ == 'green' and shape_ == 'rectangle') or (color_ == 'yellow' and shape_ == 'ellipse') or (color_ == 'white' and shape_ == 'circle') or (color_ == 'gray' and shape_ == 'square'):
-                combo = True
-            else:
-                combo = False
-            while combo:
-                color_ = random_color()
-                shape_ = random_shape()
-                if not ((color_ == 'red' and shape_ == 'circle') or (color_ == 'blue' and shape_ == 'square') or (color_ == 'green' and shape_ == 'rectangle') or (color_ == 'yellow' and shape_ == 'ellipse') or (color_ == 'white' and shape_ == 'circle') or (color_ == 'gray' and shape_ == 'square')):
-                    combo = False"""
-            # combo generalization - test
-            """
-            if label == 1:
-                combos = [('red','circle'),('blue','square'),('green','rectangle'),('yellow','ellipse'),('white','circle'),('gray','square')]
-                combo = combos[np.random.randint(0,len(combos))]
-                color_ = combo[0]
-                shape_ = combo[1]"""
-                        
+            relation = distractor_relation(spec, context, w_idx)
+            color_, shape_ = sample_pair(target, relation, generalization, role='distractor')
+
         shapes.append(shape_)
         colors.append(color_)
         shape = SHAPE_IMPLS[shape_](color=color_)
         
         # Create image and draw shape
-        img = I()
-        img.draw_shapes([shape])
-        imgs[w_idx] = img.array()
+        if draw:
+            img = I()
+            img.draw_shapes([shape])
+            imgs[w_idx] = img.array()
         labels[w_idx] = label
+        scenes[w_idx, 0] = shape.params()
     
     if colors.count(colors[0])==1 and shapes.count(shapes[0])==1:
         if np.random.randint(0,2) == 0:
@@ -666,7 +986,17 @@ def generate_single(mp_args):
     else:
         config = SingleConfig(colors[0],shapes[0])
         
-    return imgs, labels, config, i
+    return imgs, labels, config, i, scenes
+
+
+def game_seed(seed, i):
+    """
+    Seed for game ``i`` of a shard seeded with ``seed`` (an int or a tuple of
+    ints, e.g. (base seed, shard)); None seeds from OS entropy.
+    """
+    if seed is None:
+        return None
+    return [int(x) for x in np.atleast_1d(seed)] + [i]
 
 
 def generate(n,
@@ -679,7 +1009,12 @@ def generate(n,
              pool=None,
              do_mp=True,
              verbose=False,
-             context=None):
+             context=None,
+             desc=None,
+             position=None,
+             backend='aggdraw',
+             seed=None,
+             generalization=None):
     if not do_mp and pool is not None:
         raise ValueError("Can't specify pool if do_mp=True")
     if do_mp:
@@ -702,20 +1037,32 @@ def generate(n,
 
     all_imgs = np.zeros((n, n_images, 64, 64, 3), dtype=np.uint8)
     all_labels = np.zeros((n, n_images), dtype=np.uint8)
+    all_scenes = np.zeros((n, n_images, MAX_SHAPES, len(SCENE_FIELDS)), dtype=np.int16)
     configs = []
 
-    mp_args = [(n_images, correct, i, data_type, context) for i in range(n)]
+    if backend not in BACKENDS:
+        raise NotImplementedError("backend = {}".format(backend))
+    # With the numpy backend workers only sample scenes, drawn below in bulk
+    draw = backend == 'aggdraw'
+    # Each game is seeded on its own, so results don't depend on the pool
+    mp_args = [(n_images, correct, i, data_type, context, draw, game_seed(seed, i),
+                generalization) for i in range(n)]
     if do_mp:
         gen_iter = pool.imap(img_func, mp_args)
     else:
         gen_iter = map(img_func, mp_args)
     if verbose:
-        gen_iter = tqdm(gen_iter, total=n)
+        gen_iter = tqdm(gen_iter, total=n, desc=desc, position=position)
     
-    for imgs, labels, config, i in gen_iter:
+    for imgs, labels, config, i, scenes in gen_iter:
         all_imgs[i, ] = imgs
         all_labels[i, ] = labels
+        all_scenes[i, ] = scenes
         configs.append(config)
+    if backend == 'numpy':
+        chunks = np.array_split(all_scenes, max(n // RENDER_CHUNK, 1))
+        rendered = pool.map(render_scenes, chunks) if do_mp else map(render_scenes, chunks)
+        all_imgs = np.concatenate(list(rendered))
     if do_mp and pool_was_none:  # Remember to close the pool
         pool.close()
         pool.join()
@@ -723,8 +1070,186 @@ def generate(n,
     if float_type:
         all_imgs = np.divide(all_imgs, TWOFIVEFIVE)
         all_labels = all_labels.astype(np.float32)
-    langs = np.array([fmt_config(c) for c in configs], dtype=np.unicode)
-    return {'imgs': all_imgs, 'labels': all_labels, 'langs': langs}
+    langs = np.array([fmt_config(c) for c in configs], dtype=np.str_)
+    return {'imgs': all_imgs, 'labels': all_labels, 'langs': langs, 'scenes': all_scenes}
+
+
+def compare_backends(n=100, n_images=3, img_func=generate_single, threshold=64):
+    """
+    Check the numpy backend against aggdraw: draw ``n`` games with aggdraw,
+    rasterize the same scenes with ``render_scenes`` and return the mean
+    absolute pixel difference and the fraction of pixels off by more than
+    ``threshold`` in any channel.
+    """
+    data = generate(n, n_images, 0.5, data_type='reference', img_func=img_func,
+                    do_mp=False)
+    diff = np.abs(render_scenes(data['scenes']).astype(np.int16) - data['imgs'])
+    return diff.mean(), (diff.max(-1) > threshold).mean()
+
+
+def write_shard(file, data, parametric=False, palette=False, quantize=False, roles=None):
+    """
+    Save a shard returned by ``generate`` and record it in its directory's
+    manifest.
+    Parameters
+    ----------
+    file : ``str``
+        Output npz path
+    data : ``dict``
+        Output of ``generate``; modified in place
+    parametric : ``bool``, optional (default: False)
+        Store scene parameters instead of images
+    palette : ``bool``, optional (default: False)
+        Store images as a palette index image (see ``palettize``)
+    quantize : ``bool``, optional (default: False)
+        With ``palette``, quantize to one shared 256-color palette (lossy)
+    roles : ``list``, optional (default: None)
+        Split roles recorded in the manifest
+    """
+    # manifest imports this module
+    import manifest
+
+    if parametric:
+        data.pop('imgs')
+    else:
+        data.pop('scenes')
+    if palette and not parametric:
+        img_idx, pal = palettize(data.pop('imgs'), quantize=quantize)
+        data.update(img_idx=img_idx, palette=pal)
+    np.savez_compressed(file, **data)
+    manifest.add_shard(file, data, roles=roles)
+    return file
+
+
+def generate_shards(files,
+                    n,
+                    n_images,
+                    correct,
+                    data_type='reference',
+                    img_func=generate_spatial,
+                    n_cpu=None,
+                    do_mp=True,
+                    concurrent=1,
+                    verbose=False,
+                    layout=None,
+                    backend='aggdraw',
+                    seed=None,
+                    context=None,
+                    generalization=None,
+                    **write_kwargs):
+    """
+    Generate and write one shard per file. A single worker pool is shared by
+    all shards, up to ``concurrent`` shards are generated at once, and
+    compressing/writing a shard (``write_shard``) runs on a background thread
+    while the next shards are generated.
+    Parameters
+    ----------
+    files : ``list``
+        Output npz paths
+    n, n_images, correct, data_type, img_func, backend, context, generalization :
+        As for ``generate``
+    n_cpu : ``int``, optional (default: None)
+        Pool size, defaults to the number of cores
+    do_mp : ``bool``, optional (default: True)
+        Use a worker pool at all
+    concurrent : ``int``, optional (default: 1)
+        Shards generated at the same time, each with its own progress bar
+    verbose : ``bool``, optional (default: False)
+        Show per-shard progress
+    layout : ``str``, optional (default: None)
+        ``manifest.LAYOUTS`` entry used to record the split roles of shard
+        ``files[i]`` as shard number i
+    seed : ``int`` or ``tuple``, optional (default: None)
+        Base seed; game j of shard i is then seeded with (seed, i, j), so any
+        shard or game can be regenerated exactly
+    write_kwargs :
+        Passed on to ``write_shard``
+    """
+    import manifest
+
+    pool = mp.Pool(n_cpu or mp.cpu_count()) if do_mp else None
+    writer = ThreadPoolExecutor(max_workers=1)
+    # Bounds the generated shards held in memory waiting to be written
+    pending = threading.BoundedSemaphore(concurrent + 1)
+
+    def make(i, file):
+        pending.acquire()
+        try:
+            data = generate(
+                n, n_images, correct, data_type=data_type, img_func=img_func,
+                pool=pool, do_mp=do_mp, verbose=verbose,
+                desc=os.path.basename(file), position=i % concurrent,
+                backend=backend, seed=game_seed(seed, i),
+                context=context, generalization=generalization)
+            roles = manifest.layout_roles(layout, i) if layout else None
+            write = writer.submit(write_shard, file, data, roles=roles, **write_kwargs)
+        except BaseException:
+            pending.release()
+            raise
+        write.add_done_callback(lambda _: pending.release())
+        return write
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent) as shards:
+            writes = list(shards.map(make, range(len(files)), files))
+        for write in writes:
+            write.result()
+    finally:
+        writer.shutdown(wait=True)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return files
+
+
+def _pack_rgb(rgb):
+    rgb = rgb.astype(np.uint64)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def _unpack_rgb(keys):
+    return np.stack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255], -1).astype(np.uint8)
+
+
+def palettize(imgs, max_colors=256, quantize=False):
+    """
+    Encode RGB images of shape (n, ..., 3) as a single-channel index image
+    plus one palette per game, so that ``palette[g][img_idx[g]]`` recovers
+    game g. A game's palette is black, its shape colors and their antialiased
+    blends: under 200 colors where a whole shard has over 1000, so indices fit
+    in uint8 without loss. Palettes are padded to the largest game's, giving
+    an (n, P, 3) array; should a game exceed 256 colors, indices are uint16.
+
+    With ``quantize``, every color is instead mapped to the nearest of the
+    shard's ``max_colors`` most frequent ones and the palette is one shared
+    (max_colors, 3) array (lossy, only antialiased edge pixels change).
+    """
+    n = imgs.shape[0]
+    if quantize:
+        # Pack RGB into one integer per pixel, much faster to unique than rows
+        keys, inverse, counts = np.unique(
+            _pack_rgb(imgs.reshape(-1, 3)), return_inverse=True, return_counts=True)
+        palette = _unpack_rgb(keys)
+        if len(palette) > max_colors:
+            keep = np.argsort(-counts, kind='stable')[:max_colors]
+            diff = palette[:, None, :].astype(np.int32) - palette[keep][None].astype(np.int32)
+            inverse = np.argmin((diff ** 2).sum(-1), axis=1)[inverse]
+            palette = palette[keep]
+    else:
+        # Pack (game, RGB) likewise, so unique sorts colors by game
+        game = np.arange(n, dtype=np.uint64)[:, None]
+        keys, inverse = np.unique(
+            (game << 24) | _pack_rgb(imgs.reshape(n, -1, 3)), return_inverse=True)
+        key_game = (keys >> 24).astype(np.int64)
+        # Position of each color within its game's palette
+        starts = np.searchsorted(key_game, np.arange(n))
+        pos = np.arange(len(keys)) - starts[key_game]
+        palette = np.zeros((n, pos.max() + 1, 3), dtype=np.uint8)
+        palette[key_game, pos] = _unpack_rgb(keys)
+        inverse = pos[inverse.ravel()]
+    dtype = np.uint8 if palette.shape[-2] <= 256 else np.uint16
+    img_idx = inverse.reshape(imgs.shape[:-1]).astype(dtype)
+    return img_idx, palette
 
 
 def save_images(img_dir, data):
@@ -808,6 +1333,48 @@ if __name__ == '__main__':
         '--out', default='../data/single/reference-1000-10.npz',
         help='Save dataset to this file'
     )
+    parser.add_argument(
+        '--parametric', action='store_true',
+        help='Store scene parameters instead of pixels (rendered on load)'
+    )
+    parser.add_argument(
+        '--palette', action='store_true',
+        help='Store images as a single-channel palette index image'
+    )
+    parser.add_argument(
+        '--quantize', action='store_true',
+        help='With --palette, quantize to one shared 256-color palette (lossy, slightly smaller)'
+    )
+
+    parser.add_argument(
+        '--backend', choices=BACKENDS, default='aggdraw',
+        help='Draw images per game with aggdraw, rasterize all games at once with numpy, '
+             'or skip images (scenes, with --parametric)'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help='Seed games by (seed, shard, game index) so shards can be regenerated'
+    )
+    parser.add_argument(
+        '--context', choices=['shape', 'color', 'both', 'none'], default=None,
+        help='Single images: what the target shares with the distractors'
+    )
+    parser.add_argument(
+        '--generalization', choices=sorted(GENERALIZATION), default=None,
+        help='Single images: hold out these (color, shape) pairs, see GENERALIZATION'
+    )
+    parser.add_argument(
+        '--generalization_split', choices=GENERALIZATION_SPLITS, default='train',
+        help='With --generalization, exclude the held-out pairs (train) or use them as targets (test)'
+    )
+    parser.add_argument(
+        '--n_cpu', type=int, default=None,
+        help='Worker processes shared by all shards (default: all cores)'
+    )
+    parser.add_argument(
+        '--concurrent_shards', type=int, default=1,
+        help='Shards generated at the same time'
+    )
 
     args = parser.parse_args()
 
@@ -815,11 +1382,19 @@ if __name__ == '__main__':
     data_dir = './data/shapeworld/reference-1000-'
     #files = [data_dir+'0.npz', data_dir+'1.npz', data_dir+'2.npz', data_dir+'3.npz', data_dir+'4.npz',data_dir+'5.npz', data_dir+'6.npz', data_dir+'7.npz', data_dir+'8.npz', data_dir+'9.npz',data_dir+'10.npz', data_dir+'11.npz', data_dir+'12.npz', data_dir+'13.npz', data_dir+'14.npz',data_dir+'15.npz', data_dir+'16.npz', data_dir+'17.npz', data_dir+'18.npz', data_dir+'19.npz',data_dir+'20.npz', data_dir+'21.npz', data_dir+'22.npz', data_dir+'23.npz', data_dir+'24.npz',data_dir+'25.npz', data_dir+'26.npz', data_dir+'27.npz', data_dir+'28.npz', data_dir+'29.npz',data_dir+'30.npz', data_dir+'31.npz', data_dir+'32.npz', data_dir+'33.npz', data_dir+'34.npz',data_dir+'35.npz', data_dir+'36.npz', data_dir+'37.npz', data_dir+'38.npz', data_dir+'39.npz',data_dir+'40.npz', data_dir+'41.npz', data_dir+'42.npz', data_dir+'43.npz', data_dir+'44.npz',data_dir+'45.npz', data_dir+'46.npz', data_dir+'47.npz', data_dir+'48.npz', data_dir+'49.npz',data_dir+'50.npz', data_dir+'51.npz', data_dir+'52.npz', data_dir+'53.npz', data_dir+'54.npz',data_dir+'70.npz', data_dir+'71.npz', data_dir+'72.npz', data_dir+'73.npz', data_dir+'74.npz']
     files = [data_dir+f'{x}.npz' for x in range(75)]
-    for file in files:
-        data = generate(
-            args.n_examples, args.n_images, args.correct, verbose=True,
-            data_type=args.data_type,
-            img_func=IMG_FUNCS[args.img_type],
-            do_mp=not args.no_mp,
-            context=None)
-        np.savez_compressed(file, **data)
+    generate_shards(
+        files, args.n_examples, args.n_images, args.correct,
+        data_type=args.data_type,
+        img_func=IMG_FUNCS[args.img_type],
+        n_cpu=args.n_cpu,
+        do_mp=not args.no_mp,
+        concurrent=args.concurrent_shards,
+        verbose=True,
+        layout='shapeworld',
+        backend=args.backend,
+        seed=args.seed,
+        context=args.context,
+        generalization=args.generalization and (args.generalization, args.generalization_split),
+        parametric=args.parametric,
+        palette=args.palette,
+        quantize=args.quantize)
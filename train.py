@@ -15,6 +15,8 @@ import pandas as pd
 
 import vision
 import util
+import registry
+import manifest
 from data import ShapeWorld
 import data
 
@@ -53,6 +55,13 @@ if __name__ == '__main__':
     parser.add_argument('--debug', action='store_true', help='Print metrics on every epoch')
     parser.add_argument('--generalization', default=None)
     parser.add_argument('--eval_only', action='store_true', help='Eval all models')
+    parser.add_argument('--color_features', default=None, choices=['rgb', 'fourier'], help='Colors only: feed models color feature vectors through an MLP instead of images through Conv4')
+    parser.add_argument('--procedural', default=0, type=int, help='Shapeworld only: train speakers on this many procedurally generated batches per epoch instead of the training shards (0 uses the shards)')
+    parser.add_argument('--procedural_workers', default=0, type=int, help='Worker processes generating procedural batches')
+    parser.add_argument('--procedural_backend', default='aggdraw', choices=['aggdraw', 'numpy'], help='Image backend of procedural batches (numpy is faster but differs slightly from the aggdraw images listeners were trained on)')
+    parser.add_argument('--uint8_images', action='store_true', help='Keep images uint8 until they reach the model (cast to float on the device)')
+    parser.add_argument('--pin_memory', action='store_true', help='With --cuda, pin batches in host memory and copy them to the GPU asynchronously')
+    parser.add_argument('--shuffle_buffer', default=0, type=int, help='Shuffle training games across shards with a buffer of this many games (0 keeps shard order)')
     args = parser.parse_args()
     
     if args.l0 and args.lr == None:
@@ -63,23 +72,21 @@ if __name__ == '__main__':
     # Data
     if args.dataset == 'shapeworld':
         if args.generalization == None:
-            data_dir = './data/shapeworld/reference-1000-'
-            pretrain_data = [[data_dir+'0.npz', data_dir+'1.npz', data_dir+'2.npz', data_dir+'3.npz', data_dir+'4.npz'],[data_dir+'5.npz', data_dir+'6.npz', data_dir+'7.npz', data_dir+'8.npz', data_dir+'9.npz'],[data_dir+'10.npz', data_dir+'11.npz', data_dir+'12.npz', data_dir+'13.npz', data_dir+'14.npz'],[data_dir+'15.npz', data_dir+'16.npz', data_dir+'17.npz', data_dir+'18.npz', data_dir+'19.npz'],[data_dir+'20.npz', data_dir+'21.npz', data_dir+'22.npz', data_dir+'23.npz', data_dir+'24.npz'],[data_dir+'25.npz', data_dir+'26.npz', data_dir+'27.npz', data_dir+'28.npz', data_dir+'29.npz'],[data_dir+'30.npz', data_dir+'31.npz', data_dir+'32.npz', data_dir+'33.npz', data_dir+'34.npz'],[data_dir+'35.npz', data_dir+'36.npz', data_dir+'37.npz', data_dir+'38.npz', data_dir+'39.npz'],[data_dir+'40.npz', data_dir+'41.npz', data_dir+'42.npz', data_dir+'43.npz', data_dir+'44.npz'],[data_dir+'45.npz', data_dir+'46.npz', data_dir+'47.npz', data_dir+'48.npz', data_dir+'49.npz'],[data_dir+'50.npz', data_dir+'51.npz', data_dir+'52.npz', data_dir+'53.npz', data_dir+'54.npz'],[data_dir+'70.npz', data_dir+'71.npz', data_dir+'72.npz', data_dir+'73.npz', data_dir+'74.npz']]
+            data_dir, layout = './data/shapeworld', 'shapeworld'
         else:
-            data_dir = './data/shapeworld/generalization/'+args.generalization+'/reference-1000-'
-            pretrain_data = [[data_dir+'0.npz', data_dir+'1.npz', data_dir+'2.npz', data_dir+'3.npz', data_dir+'4.npz'],[data_dir+'5.npz', data_dir+'6.npz', data_dir+'7.npz', data_dir+'8.npz', data_dir+'9.npz']]
-        #train_data = [data_dir+'60.npz', data_dir+'61.npz', data_dir+'62.npz', data_dir+'63.npz', data_dir+'64.npz']
-        train_data = [f'{data_dir}{x}.npz' for x in range(30)]
-        val_data = [data_dir+'65.npz', data_dir+'66.npz', data_dir+'67.npz', data_dir+'68.npz', data_dir+'69.npz']
+            data_dir, layout = './data/shapeworld/generalization/'+args.generalization, 'shapeworld_generalization'
+        group_size = 5
         
     elif args.dataset == 'colors':
         DatasetClass = ColorsInContext
-        data_dir = './data/colors/data_1000_'
-        pretrain_data = [[data_dir+'0.npz', data_dir+'1.npz', data_dir+'2.npz', data_dir+'3.npz', data_dir+'4.npz', data_dir+'5.npz', data_dir+'6.npz', data_dir+'7.npz', data_dir+'8.npz', data_dir+'9.npz', data_dir+'10.npz', data_dir+'11.npz', data_dir+'12.npz', data_dir+'13.npz', data_dir+'14.npz'],[data_dir+'15.npz', data_dir+'16.npz', data_dir+'17.npz', data_dir+'18.npz', data_dir+'19.npz', data_dir+'20.npz', data_dir+'21.npz', data_dir+'22.npz', data_dir+'23.npz', data_dir+'24.npz', data_dir+'25.npz', data_dir+'26.npz', data_dir+'27.npz', data_dir+'28.npz', data_dir+'29.npz'],[data_dir+'30.npz', data_dir+'31.npz', data_dir+'32.npz', data_dir+'33.npz', data_dir+'34.npz', data_dir+'35.npz', data_dir+'36.npz', data_dir+'37.npz', data_dir+'38.npz', data_dir+'39.npz', data_dir+'40.npz', data_dir+'41.npz', data_dir+'42.npz', data_dir+'43.npz', data_dir+'44.npz']]
-        train_data = [data_dir+'0.npz', data_dir+'1.npz', data_dir+'2.npz', data_dir+'3.npz', data_dir+'4.npz', data_dir+'5.npz', data_dir+'6.npz', data_dir+'7.npz', data_dir+'8.npz', data_dir+'9.npz', data_dir+'10.npz', data_dir+'11.npz', data_dir+'12.npz', data_dir+'13.npz', data_dir+'14.npz']
-        val_data = [data_dir+'15.npz', data_dir+'16.npz', data_dir+'17.npz', data_dir+'18.npz', data_dir+'19.npz', data_dir+'20.npz', data_dir+'21.npz', data_dir+'22.npz', data_dir+'23.npz', data_dir+'24.npz', data_dir+'25.npz', data_dir+'26.npz', data_dir+'27.npz', data_dir+'28.npz', data_dir+'29.npz']
+        data_dir, layout = './data/colors', 'colors'
+        group_size = 15
     else:
         raise Exception('Dataset '+args.dataset+' is not defined.')
+    # Shard lists come from the data directory's manifest (built on first use)
+    pretrain_data = manifest.groups(manifest.shards(data_dir, 'pretrain', layout), group_size)
+    train_data = manifest.shards(data_dir, 'train', layout)
+    val_data = manifest.shards(data_dir, 'val', layout)
         
     # Load or Generate Vocab
     if args.vocab:
@@ -92,27 +99,35 @@ if __name__ == '__main__':
         torch.save(vocab,'./models/'+args.dataset+'/vocab.pt')
     else:
         vocab = torch.load('./models/'+args.dataset+'/vocab.pt')
+    if args.procedural and args.dataset == 'shapeworld':
+        # unlimited training games, generated per epoch (seed = epoch)
+        train_data = data.ProceduralShapeWorld(vocab, args.procedural, args.batch_size, backend=args.procedural_backend, num_workers=args.procedural_workers)
     
     # Initialize Speakers and Listener Model
+    def feat_model():
+        # solid color stimuli only need a small MLP over their color features
+        if args.color_features:
+            return models.FeatureMLP(data.color_feature_dim(args.color_features), 64)
+        return vision.Conv4()
      
     # literal speaker s0
     speaker_embs = nn.Embedding(len(vocab['w2i'].keys()), 50)
-    speaker_vision = vision.Conv4()
+    speaker_vision = feat_model()
     speaker = models.LiteralSpeaker(speaker_vision, speaker_embs)
 
     # amortized speaker
     a_speaker_embs = nn.Embedding(len(vocab['w2i'].keys()), 50)
-    a_speaker_vision = vision.Conv4()
+    a_speaker_vision = feat_model()
     a_speaker = models.Speaker(a_speaker_vision, a_speaker_embs)
 
     # conditional speaker that does not see target
     c_speaker_embs = nn.Embedding(len(vocab['w2i'].keys()), 50)
-    c_speaker_vision = vision.Conv4()
+    c_speaker_vision = feat_model()
     c_speaker = models.LiteralSpeaker(a_speaker_vision, a_speaker_embs, contextual=False, marginal=True)
 
     # listener
     listener_embs = nn.Embedding(len(vocab['w2i'].keys()), 50)
-    listener_vision = vision.Conv4()
+    listener_vision = feat_model()
     listener = models.Listener(listener_vision, listener_embs)
     if args.cuda:
         speaker = speaker.cuda()
@@ -145,45 +160,45 @@ if __name__ == '__main__':
         NS = 1
 
         # load all models (on cuda)
-        literal_listener = torch.load('./models/'+args.dataset+'/literal_listener_0.pt').cuda()
-        literal_listener_val = torch.load('./models/'+args.dataset+'/literal_listener_1.pt').cuda()
-        val_metrics, _ = run(val_data, 'test', 'l0', None, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, debug = args.debug)
+        literal_listener = registry.load_model('./models/'+args.dataset+'/literal_listener_0.pt').cuda()
+        literal_listener_val = registry.load_model('./models/'+args.dataset+'/literal_listener_1.pt').cuda()
+        val_metrics, _ = run(val_data, 'test', 'l0', None, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
         print("Literal listener")
         print(val_metrics)
 
-        language_model = torch.load('./models/'+args.dataset+'/language-model.pt').cuda()
-        val_metrics, _ = run(val_data, 'test', 'language_model', language_model, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug)
+        language_model = registry.load_model('./models/'+args.dataset+'/language-model.pt').cuda()
+        val_metrics, _ = run(val_data, 'test', 'language_model', language_model, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
         print("Language model")
         print(val_metrics)
 
-        literal_speaker = torch.load('./models/'+args.dataset+'/literal_speaker.pt').cuda()
-        val_metrics, _ = run(val_data, 'test', 'sample', literal_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, num_samples=NS, lmbd = args.lmbd, debug = args.debug)
+        literal_speaker = registry.load_model('./models/'+args.dataset+'/literal_speaker.pt').cuda()
+        val_metrics, _ = run(val_data, 'test', 'sample', literal_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, num_samples=NS, lmbd = args.lmbd, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
         print("Literal speaker")
         print(val_metrics)
 
         # dont run this...
         """
-        conditional_speaker = torch.load('./models/'+args.dataset+'/conditional_speaker.pt').cuda()
-        val_metrics, _ = run(val_data, 'test', 'sample', conditional_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, num_samples=NS, lmbd = args.lmbd, debug = args.debug)
+        conditional_speaker = registry.load_model('./models/'+args.dataset+'/conditional_speaker.pt').cuda()
+        val_metrics, _ = run(val_data, 'test', 'sample', conditional_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, num_samples=NS, lmbd = args.lmbd, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
         print("Conditional speaker")
         print(val_metrics)
         """
 
-        state_dict = torch.load('./models/'+args.dataset+'/amortized_speaker_length.pt').state_dict()
+        state_dict = registry.load_model('./models/'+args.dataset+'/amortized_speaker_length.pt').state_dict()
         a_speaker.load_state_dict(state_dict)
-        val_metrics, _ = run(val_data, 'test', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = "gumbel", dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug)
+        val_metrics, _ = run(val_data, 'test', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = "gumbel", dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
         print("Amortized speaker length")
         print(val_metrics)
 
-        state_dict = torch.load('./models/'+args.dataset+'/amortized_speaker_bayes.pt').state_dict()
+        state_dict = registry.load_model('./models/'+args.dataset+'/amortized_speaker_bayes.pt').state_dict()
         a_speaker.load_state_dict(state_dict)
-        val_metrics, _ = run(val_data, 'test', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = "gumbel", dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug)
+        val_metrics, _ = run(val_data, 'test', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = "gumbel", dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
         print("Amortized speaker bayes")
         print(val_metrics)
 
-        state_dict = torch.load('./models/'+args.dataset+'/amortized_speaker_map.pt').state_dict()
+        state_dict = registry.load_model('./models/'+args.dataset+'/amortized_speaker_map.pt').state_dict()
         a_speaker.load_state_dict(state_dict)
-        val_metrics, _ = run(val_data, 'test', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = "gumbel", dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug)
+        val_metrics, _ = run(val_data, 'test', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = "gumbel", dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
         print("Amortized speaker map")
         print(val_metrics)
 
@@ -207,7 +222,7 @@ if __name__ == '__main__':
             # Reinitialize metrics, listener model, and optimizer
             metrics = init_metrics()
             listener_embs = nn.Embedding(len(vocab['w2i'].keys()), 50)
-            listener_vision = vision.Conv4()
+            listener_vision = feat_model()
             listener = models.Listener(listener_vision, listener_embs)
             if args.cuda:
                 listener = listener.cuda()
@@ -216,11 +231,11 @@ if __name__ == '__main__':
             for epoch in range(args.epochs):
                 # Train one epoch
                 data_file = file[0:len(file)-1]
-                train_metrics, _ = run(data_file, 'train', 'l0', None, listener, optimizer, loss, vocab, args.batch_size, args.cuda, debug = args.debug)
+                train_metrics, _ = run(data_file, 'train', 'l0', None, listener, optimizer, loss, vocab, args.batch_size, args.cuda, debug = args.debug, shuffle_buffer = args.shuffle_buffer, seed = epoch, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
 
                 # Validate
                 data_file = [file[-1]]
-                val_metrics, _ = run(data_file, 'val', 'l0', None, listener, optimizer, loss, vocab, args.batch_size, args.cuda, debug = args.debug)
+                val_metrics, _ = run(data_file, 'val', 'l0', None, listener, optimizer, loss, vocab, args.batch_size, args.cuda, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
 
                 # Update metrics, prepending the split name
                 for metric, value in train_metrics.items():
@@ -247,11 +262,11 @@ if __name__ == '__main__':
     # Load Literal Listener
     if args.amortized or args.s0 or args.sc:
         if args.generalization:
-            literal_listener = torch.load('./models/shapeworld/generalization/'+args.generalization+'/literal_listener_0.pt')
-            literal_listener_val = torch.load('./models/shapeworld/generalization/'+args.generalization+'/literal_listener_1.pt')
+            literal_listener = registry.load_model('./models/shapeworld/generalization/'+args.generalization+'/literal_listener_0.pt')
+            literal_listener_val = registry.load_model('./models/shapeworld/generalization/'+args.generalization+'/literal_listener_1.pt')
         else:
-            literal_listener = torch.load('./models/'+args.dataset+'/literal_listener_0.pt')
-            literal_listener_val = torch.load('./models/'+args.dataset+'/literal_listener_1.pt')
+            literal_listener = registry.load_model('./models/'+args.dataset+'/literal_listener_0.pt')
+            literal_listener_val = registry.load_model('./models/'+args.dataset+'/literal_listener_1.pt')
 
     # Train Literal Speaker
     if args.s0:
@@ -259,10 +274,10 @@ if __name__ == '__main__':
         metrics = init_metrics()
         for epoch in range(args.epochs):
             # Train one epoch
-            train_metrics, _ = run(train_data, 'train', 's0', speaker, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug)
+            train_metrics, _ = run(train_data, 'train', 's0', speaker, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug, shuffle_buffer = args.shuffle_buffer, seed = epoch, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
             
             # Validate
-            val_metrics, _ = run(val_data, 'val', 's0', speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug)
+            val_metrics, _ = run(val_data, 'val', 's0', speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
             
             # Update metrics, prepending the split name
             for metric, value in train_metrics.items():
@@ -300,10 +315,10 @@ if __name__ == '__main__':
         metrics = init_metrics()
         for epoch in range(args.epochs):
             # Train one epoch
-            train_metrics, _ = run(train_data, 'train', 's0', c_speaker, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug)
+            train_metrics, _ = run(train_data, 'train', 's0', c_speaker, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug, shuffle_buffer = args.shuffle_buffer, seed = epoch, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
             
             # Validate
-            val_metrics, _ = run(val_data, 'val', 's0', c_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug)
+            val_metrics, _ = run(val_data, 'val', 's0', c_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
             
             # Update metrics, prepending the split name
             for metric, value in train_metrics.items():
@@ -339,16 +354,16 @@ if __name__ == '__main__':
     if args.amortized:
         print("Training amortized speaker")
         # would be nice to initialize
-        state_dict = torch.load('./models/'+args.dataset+'/literal_speaker.pt').state_dict()
+        state_dict = registry.load_model('./models/'+args.dataset+'/literal_speaker.pt').state_dict()
         a_speaker.load_state_dict(state_dict)
 
         metrics = init_metrics()
         for epoch in range(args.epochs):
             # Train one epoch
-            train_metrics, _ = run(train_data, 'train', 'amortized', a_speaker, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = args.activation, dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug)
+            train_metrics, _ = run(train_data, 'train', 'amortized', a_speaker, literal_listener, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = args.activation, dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug, shuffle_buffer = args.shuffle_buffer, seed = epoch, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
             
             # Validate
-            val_metrics, _ = run(val_data, 'val', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = args.activation, dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug)
+            val_metrics, _ = run(val_data, 'val', 'amortized', a_speaker, literal_listener_val, optimizer, loss, vocab, args.batch_size, args.cuda, lmbd = args.lmbd, activation = args.activation, dataset = args.dataset, penalty = args.penalty, tau = args.tau, debug = args.debug, color_features = args.color_features, uint8_images = args.uint8_images, pin_memory = args.pin_memory)
 
             # Update metrics, prepending the split name
             for metric, value in train_metrics.items():
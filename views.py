@@ -0,0 +1,254 @@
+"""
+Derived splits: evaluation conditions (e.g. ``shape_needed``) and
+generalization splits stored as index views over one pool of parametric
+single-image games, instead of generating and compressing each from scratch
+"""
+
+import math
+import os
+
+import numpy as np
+
+import manifest
+import shapeworld
+from shapeworld import GENERALIZATION, GENERALIZATION_SPLITS, SHAPES, COLORS
+
+POOL_PATTERN = 'pool-{}.npz'
+# Condition -> (context, generalization) of shapeworld.generate_single whose
+# games it keeps. 'random' is the unconstrained pool itself.
+CONDITIONS = {
+    'random': (None, None),
+    'both_needed': ('both', None),
+    'either_ok': ('none', None),
+    'shape_needed': ('color', None),
+    'color_needed': ('shape', None),
+}
+for _kind in GENERALIZATION:
+    for _split in GENERALIZATION_SPLITS:
+        CONDITIONS['{}_{}'.format(_kind, _split)] = (None, (_kind, _split))
+
+
+def _held_out(kind, shape, color):
+    held_out = np.zeros(shape.shape, dtype=bool)
+    for c, s in GENERALIZATION[kind]:
+        held_out |= (color == COLORS.index(c)) & (shape == SHAPES.index(s))
+    return held_out
+
+
+def matches(scenes, context=None, generalization=None):
+    """
+    Which reference games (target first, one shape per image) could have been
+    sampled by ``generate_single`` with ``context`` and ``generalization``.
+    Parameters
+    ----------
+    scenes : ``np.Array``
+        (n, n_images, MAX_SHAPES, len(SCENE_FIELDS)) scenes of the games
+    context, generalization :
+        As for ``shapeworld.generate``
+    Returns
+    -------
+    keep : ``np.Array``
+        (n, ) bool mask
+    """
+    shape = scenes[:, :, 0, 0]
+    color = scenes[:, :, 0, 1]
+    same_shape = shape[:, 1:] == shape[:, :1]
+    same_color = color[:, 1:] == color[:, :1]
+    # No distractor may be identical to the target
+    keep = ~(same_shape & same_color).any(1)
+    if context == 'shape':
+        keep &= (same_shape & ~same_color).all(1)
+    elif context == 'color':
+        keep &= (same_color & ~same_shape).all(1)
+    elif context == 'none':
+        keep &= (~same_shape & ~same_color).all(1)
+    elif context == 'both':
+        keep &= same_shape[:, 0] & ~same_color[:, 0] & same_color[:, 1] & ~same_shape[:, 1]
+    if generalization is not None:
+        kind, split = generalization
+        held_out = _held_out(kind, shape, color)
+        keep &= ~held_out.any(1) if split == 'train' else held_out[:, 0]
+    return keep
+
+
+def _sampler(condition):
+    context, generalization = CONDITIONS[condition]
+    return [context, list(generalization) if generalization else None]
+
+
+def pool_shards(pool_dir, condition):
+    """
+    Pool shards a view of ``condition`` may draw from: the unconstrained ones
+    and those topped up for ``condition`` itself (games sampled for another
+    condition would skew its distribution).
+    """
+    entries = manifest.load_manifest(pool_dir)['shards']
+    sampler = _sampler(condition)
+    return [
+        path for path in manifest.shards(pool_dir)
+        if entries[os.path.basename(path)].get('sampler') in (None, [None, None], sampler)
+    ]
+
+
+def grow_pool(pool_dir, n_shards, condition='random', n_games=1000, seed=None, **kwargs):
+    """
+    Add ``n_shards`` parametric shards of ``n_games`` games sampled for
+    ``condition`` to the pool, numbered after the existing ones.
+    Parameters
+    ----------
+    seed : ``int``, optional (default: None)
+        Base seed; the i-th new shard is seeded with (seed, first new shard
+        number, i)
+    kwargs :
+        Passed on to ``shapeworld.generate_shards`` (e.g. ``n_cpu``)
+    """
+    os.makedirs(pool_dir, exist_ok=True)
+    start = len(manifest.load_manifest(pool_dir)['shards'])
+    files = [os.path.join(pool_dir, POOL_PATTERN.format(k)) for k in range(start, start + n_shards)]
+    context, generalization = CONDITIONS[condition]
+    shapeworld.generate_shards(
+        files, n_games, 3, 0.5, data_type='reference',
+        img_func=shapeworld.generate_single, backend='scenes',
+        seed=None if seed is None else (seed, start), context=context,
+        generalization=generalization, parametric=True, **kwargs)
+    pool = manifest.load_manifest(pool_dir)
+    for file in files:
+        pool['shards'][os.path.basename(file)]['sampler'] = _sampler(condition)
+    manifest.save_manifest(pool_dir, pool)
+    return files
+
+
+def select(pool_dir, condition, n):
+    """
+    Up to ``n`` games of the pool matching ``condition``, in shard order.
+    Returns
+    -------
+    files : ``list``
+        Pool shard paths
+    shard, game : ``np.Array``
+        Index into ``files`` and game index within that shard, per game
+    """
+    files = pool_shards(pool_dir, condition)
+    shard, game = [], []
+    found = 0
+    for k, path in enumerate(files):
+        if found >= n:
+            break
+        idx = np.nonzero(matches(np.load(path)['scenes'], *CONDITIONS[condition]))[0]
+        idx = idx[:n - found]
+        shard.append(np.full(len(idx), k, dtype=np.int32))
+        game.append(idx.astype(np.int32))
+        found += len(idx)
+    if not shard:
+        return files, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    return files, np.concatenate(shard), np.concatenate(game)
+
+
+def materialize(pool_dir, out_files, condition, n_games=1000, roles=None,
+                top_up=True, seed=None, **kwargs):
+    """
+    Write ``out_files`` as views of ``n_games`` distinct pool games each
+    matching ``condition``. Missing games are first topped up with pool
+    shards sampled for ``condition`` directly (see ``grow_pool``).
+    Parameters
+    ----------
+    pool_dir : ``str``
+        Directory of pool shards
+    out_files : ``list``
+        Output npz paths; views load like any other shard
+    condition : ``str``
+        ``CONDITIONS`` key
+    n_games : ``int``, optional (default: 1000)
+        Games per output file
+    roles : ``list``, optional (default: None)
+        Manifest roles per output file
+    top_up : ``bool``, optional (default: True)
+        Generate missing games; otherwise write what the pool has
+    seed : ``int``, optional (default: None)
+        Base seed of top-up shards
+    kwargs :
+        Passed on to ``grow_pool``
+    """
+    n = n_games * len(out_files)
+    files, shard, game = select(pool_dir, condition, n)
+    if len(game) < n and top_up:
+        grow_pool(pool_dir, math.ceil((n - len(game)) / n_games), condition,
+                  n_games=n_games, seed=seed, **kwargs)
+        files, shard, game = select(pool_dir, condition, n)
+    labels, langs = [], []
+    for k, path in enumerate(files):
+        data = np.load(path)
+        idx = game[shard == k]
+        labels.append(data['labels'][idx])
+        langs.append(data['langs'][idx])
+    labels = np.concatenate(labels) if labels else np.zeros((0, 3), dtype=np.uint8)
+    langs = np.concatenate(langs) if langs else np.zeros(0, dtype=np.str_)
+    for j, out_file in enumerate(out_files):
+        rows = slice(j * n_games, (j + 1) * n_games)
+        out_dir = os.path.dirname(out_file) or '.'
+        os.makedirs(out_dir, exist_ok=True)
+        data = {
+            'pool': np.array([os.path.relpath(f, out_dir) for f in files], dtype=np.str_),
+            'shard': shard[rows],
+            'game': game[rows],
+            'labels': labels[rows],
+            'langs': langs[rows],
+        }
+        np.savez_compressed(out_file, **data)
+        manifest.add_shard(out_file, data, roles=roles[j] if roles else None)
+    return out_files
+
+
+def materialize_layout(pool_dir, out_dir, condition, layout, n_games=1000, **kwargs):
+    """``materialize`` every shard of ``manifest.LAYOUTS[layout]`` in ``out_dir``."""
+    spec = manifest.LAYOUTS[layout]
+    out_files = [os.path.join(out_dir, spec['pattern'].format(i)) for i in range(spec['n_shards'])]
+    roles = [manifest.layout_roles(layout, i) for i in range(spec['n_shards'])]
+    return materialize(pool_dir, out_files, condition, n_games, roles=roles, **kwargs)
+
+
+def view_scenes(view_file, data):
+    """Gather the scenes of a view (opened as ``data``) from its pool shards."""
+    view_dir = os.path.dirname(view_file)
+    shard, game = data['shard'], data['game']
+    scenes = None
+    for k, path in enumerate(data['pool']):
+        rows = np.nonzero(shard == k)[0]
+        if len(rows) == 0:
+            continue
+        pool_scenes = np.load(os.path.join(view_dir, str(path)))['scenes']
+        if scenes is None:
+            scenes = np.zeros((len(game), ) + pool_scenes.shape[1:], dtype=pool_scenes.dtype)
+        scenes[rows] = pool_scenes[game[rows]]
+    return scenes
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(description='Grow a pool of games or write views of it',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('pool_dir')
+    parser.add_argument('--grow', type=int, default=0,
+                        help='Add this many unconstrained shards to the pool')
+    parser.add_argument('--condition', choices=sorted(CONDITIONS), default=None,
+                        help='Write a view of the games matching this condition')
+    parser.add_argument('--out', default=None,
+                        help='View npz path, or directory with --layout')
+    parser.add_argument('--layout', default=None, choices=sorted(manifest.LAYOUTS),
+                        help='Write every shard of this layout into --out')
+    parser.add_argument('--n_games', type=int, default=1000, help='Games per shard')
+    parser.add_argument('--no_top_up', action='store_true',
+                        help='Do not generate games the pool is missing')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--n_cpu', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.grow:
+        grow_pool(args.pool_dir, args.grow, n_games=args.n_games, seed=args.seed, n_cpu=args.n_cpu)
+    if args.condition is not None:
+        kwargs = dict(n_games=args.n_games, top_up=not args.no_top_up, seed=args.seed, n_cpu=args.n_cpu)
+        if args.layout:
+            materialize_layout(args.pool_dir, args.out, args.condition, args.layout, **kwargs)
+        else:
+            materialize(args.pool_dir, [args.out], args.condition, **kwargs)
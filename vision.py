@@ -350,6 +350,10 @@ class ConvNet(nn.Module):
         self.final_feat_dim = 1024
 
     def forward(self, x):
+        # uint8 images are cast here, on device. Pixel values are not
+        # rescaled, matching how the pretrained models were trained.
+        if not x.is_floating_point():
+            x = x.float()
         out = self.trunk(x)
         return out
 